@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+# headless drivers have to be selected before pygame creates a display or mixer
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+from settings import SCREEN_WIDTH, SCREEN_HEIGHT, LEVEL_PATH
+from profiler import profiler
+from support import rng, AtlasTexture, ScaledSurfaces
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+class MapGenerator:
+    # builds a synthetic map by repeating a source room in a grid and multiplying its objects
+    @staticmethod
+    def generate(source_path, rooms, density, seed, target_dir):
+        rng = random.Random(seed)
+        source_dir = os.path.dirname(os.path.abspath(source_path))
+        tree = ET.parse(source_path)
+        root = tree.getroot()
+
+        room_width = int(root.get('width'))
+        room_height = int(root.get('height'))
+        tile_width = int(root.get('tilewidth'))
+        tile_height = int(root.get('tileheight'))
+        root.set('width', str(room_width * rooms[0]))
+        root.set('height', str(room_height * rooms[1]))
+
+        # the generated file lives elsewhere, so tilesets are pointed back at the source folder
+        for tileset in root.findall('tileset'):
+            if tileset.get('source'):
+                tileset.set('source', os.path.join(source_dir, tileset.get('source')))
+
+        for layer in root.findall('layer'):
+            MapGenerator.repeat_layer(layer, room_width, room_height, rooms)
+
+        object_id = 1
+        for group in root.findall('objectgroup'):
+            objects = group.findall('object')
+            for obj in objects:
+                group.remove(obj)
+
+            for room_y in range(rooms[1]):
+                for room_x in range(rooms[0]):
+                    for obj in objects:
+                        # only one player start, in the first room
+                        if group.get('name') == 'player':
+                            copies = 1 if (room_x, room_y) == (0, 0) else 0
+                        else:
+                            copies = int(density) + (rng.random() < density % 1)
+
+                        for copy in range(copies):
+                            new_obj = ET.fromstring(ET.tostring(obj))
+                            jitter = (rng.uniform(-8, 8), rng.uniform(-8, 8)) if copy else (0, 0)
+                            new_obj.set('id', str(object_id))
+                            new_obj.set('x', str(float(obj.get('x')) + room_x * room_width * tile_width + jitter[0]))
+                            new_obj.set('y', str(float(obj.get('y')) + room_y * room_height * tile_height + jitter[1]))
+                            group.append(new_obj)
+                            object_id += 1
+
+        root.set('nextobjectid', str(object_id))
+        map_path = os.path.join(target_dir, f'synthetic_{rooms[0]}x{rooms[1]}.tmx')
+        tree.write(map_path, encoding='UTF-8', xml_declaration=True)
+        return map_path
+
+    @staticmethod
+    def repeat_layer(layer, room_width, room_height, rooms):
+        data = layer.find('data')
+        if data.get('encoding') != 'csv':
+            raise ValueError(f"layer {layer.get('name')} must use csv encoding")
+
+        gids = [gid.strip() for gid in data.text.split(',')]
+        room_rows = [gids[row * room_width:(row + 1) * room_width] for row in range(room_height)]
+        rows = [room_row * rooms[0] for _ in range(rooms[1]) for room_row in room_rows]
+
+        layer.set('width', str(room_width * rooms[0]))
+        layer.set('height', str(room_height * rooms[1]))
+        data.text = '\n' + ',\n'.join(','.join(row) for row in rows) + '\n'
+
+
+class ScriptedInput:
+    # walks the player in a square so the camera scrolls and props get pushed
+    PATTERN = [(pygame.K_d,), (pygame.K_d, pygame.K_s), (pygame.K_s,), (pygame.K_a,), (pygame.K_w,), (pygame.K_a, pygame.K_w)]
+
+    def __init__(self, segment_frames=90):
+        self.segment_frames = segment_frames
+        self.frame = 0
+
+    def get_pressed(self):
+        keys = defaultdict(bool)
+        for key in self.PATTERN[(self.frame // self.segment_frames) % len(self.PATTERN)]:
+            keys[key] = True
+        return keys
+
+
+class BlitBenchmark:
+    # blits one frame's draw list over and over: one call per sprite against a single Surface.blits call,
+    # on the normalized surfaces and on copies in the formats they used to have, per pixel alpha everywhere
+    # and a colorkey on top for texture frames
+    def __init__(self, level, repeats):
+        self.repeats = repeats
+        self.display_surface = pygame.display.get_surface()
+
+        camera = level.all_sprites
+        camera.update_offset(level.player, 1.0)
+        self.draw_list = [(image, offset_rect) for _, image, offset_rect in camera.get_draw_list(1.0)]
+
+        frames = set(AtlasTexture.cache.values())
+        legacy_images = {}
+        for image, _ in self.draw_list:
+            if image not in legacy_images:
+                legacy_image = image.convert_alpha()
+                if image in frames:
+                    legacy_image.set_colorkey((0, 0, 0))
+                legacy_images[image] = legacy_image
+        self.legacy_draw_list = [(legacy_images[image], offset_rect) for image, offset_rect in self.draw_list]
+
+    def time_blits(self, draw_list, batched):
+        blit = self.display_surface.blit
+        start = time.perf_counter()
+        for _ in range(self.repeats):
+            if batched:
+                self.display_surface.blits(draw_list, doreturn=False)
+            else:
+                for image, offset_rect in draw_list:
+                    blit(image, offset_rect)
+        return (time.perf_counter() - start) / self.repeats
+
+    def run(self):
+        results = {'sprites': len(self.draw_list),
+                   'pixels': sum(rect.width * rect.height for _, rect in self.draw_list)}
+        for name, draw_list in (('legacy', self.legacy_draw_list), ('normalized', self.draw_list)):
+            for mode, batched in (('single', False), ('batched', True)):
+                frame_time = self.time_blits(draw_list, batched)
+                results[f'{name}_{mode}_ms'] = frame_time * 1000
+                results[f'{name}_{mode}_mpixels_per_s'] = results['pixels'] / frame_time / 1e6
+        return results
+
+
+class Benchmark:
+    def __init__(self, level_path, frames, warmup, dt):
+        self.frames = frames
+        self.warmup = warmup
+        self.dt = dt
+
+        pygame.init()
+        pygame.mixer.init()
+        pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+
+        # imported here so sprites can convert surfaces against the dummy display
+        from level import Level
+
+        load_start = time.perf_counter()
+        self.level = Level(level_path)
+        self.load_time = time.perf_counter() - load_start
+        self.level.activate()
+
+        self.script = ScriptedInput()
+        self.level.player.key_source = self.script.get_pressed
+        # profiler scope -> seconds per frame, so phases added to Level show up without changes here
+        self.samples = {}
+        self.counters = {}
+        self.blit_results = None
+
+    def run(self):
+        level = self.level
+        for frame in range(self.warmup + self.frames):
+            pygame.event.pump()
+            self.script.frame = frame
+            profiler.begin_frame()
+            level.draw()
+            level.update(self.dt)
+            level.present()
+            profiler.end_frame()
+
+            if frame < self.warmup:
+                continue
+
+            for name, value in profiler.last_counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for phase, value in profiler.timings.items():
+                self.samples.setdefault(phase, []).append(value)
+
+    def run_blits(self, repeats):
+        self.blit_results = BlitBenchmark(self.level, repeats).run()
+
+    @staticmethod
+    def percentile(values, percent):
+        # an empty run, e.g. a recording quit before its first step, reports zeros like mean and max
+        if not values:
+            return 0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, round(percent / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def get_report(self):
+        phases = {}
+        for phase, values in self.samples.items():
+            stats = {f'p{percent}': self.percentile(values, percent) * 1000 for percent in PERCENTILES}
+            stats['mean'] = sum(values) / len(values) * 1000 if values else 0
+            stats['max'] = max(values, default=0) * 1000
+            phases[phase] = stats
+
+        return {'frames': self.frames,
+                'warmup': self.warmup,
+                'dt': self.dt,
+                'load_time_ms': self.load_time * 1000,
+                'sprites': len(self.level.all_sprites),
+                'objects': len(self.level.objects),
+                'collision_sprites': len(self.level.collision_sprites),
+                'physics_sprites': len(self.level.physics_sprites),
+                'phases_ms': phases,
+                'counters_per_frame': {name: value / self.frames for name, value in self.counters.items()},
+                'scaled_surfaces': ScaledSurfaces.get_stats(),
+                'texture_cache': AtlasTexture.get_stats(),
+                'blits': self.blit_results,
+                'python': platform.python_version(),
+                'pygame': pygame.version.ver,
+                'platform': platform.platform()}
+
+
+def parse_rooms(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless frame-time benchmark for Level.draw and Level.update')
+    parser.add_argument('--level', default=LEVEL_PATH['first_level'], help='source tmx map')
+    parser.add_argument('--rooms', type=parse_rooms, default=(4, 4),
+                        help='repeat the source map WxH times, 1x1 benchmarks it unchanged')
+    parser.add_argument('--density', type=float, default=1.0, help='object copies per source object')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=60)
+    parser.add_argument('--dt', type=float, default=1 / 60, help='simulated seconds per frame')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--blit-repeats', type=int, default=200, help='draws of the final frame for the blit benchmark, 0 skips it')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args(argv)
+
+    # level, data and asset paths are relative to the project root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    random.seed(args.seed)
+    rng.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as target_dir:
+        level_path = args.level
+        if args.rooms != (1, 1) or args.density != 1:
+            level_path = MapGenerator.generate(args.level, args.rooms, args.density, args.seed, target_dir)
+
+        benchmark = Benchmark(level_path, args.frames, args.warmup, args.dt)
+        benchmark.run()
+        if args.blit_repeats:
+            benchmark.run_blits(args.blit_repeats)
+
+    report = benchmark.get_report()
+    report.update({'level': args.level, 'rooms': list(args.rooms), 'density': args.density, 'seed': args.seed})
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    for phase, stats in report['phases_ms'].items():
+        print(f"{phase:<10} p50 {stats['p50']:7.3f} ms  p95 {stats['p95']:7.3f} ms  p99 {stats['p99']:7.3f} ms")
+    surfaces = report['scaled_surfaces']
+    print(f"{surfaces['surfaces']} scaled surfaces ({surfaces['bytes'] / 2 ** 20:.1f} MiB), "
+          f"{surfaces['surfaces_saved']} copies ({surfaces['bytes_saved'] / 2 ** 20:.1f} MiB) saved by interning")
+    blits = report['blits']
+    if blits:
+        print(f"blits    {blits['sprites']} sprites per frame, ms per frame (single / batched): "
+              f"legacy {blits['legacy_single_ms']:.3f} / {blits['legacy_batched_ms']:.3f}, "
+              f"normalized {blits['normalized_single_ms']:.3f} / {blits['normalized_batched_ms']:.3f}")
+    print(f'{report["sprites"]} sprites, {report["objects"]} objects, results written to {args.output}')
+
+    pygame.quit()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,49 +1,258 @@
 import pygame
+import weakref
+from math import ceil, floor
+from bisect import bisect_left, bisect_right
 from sprites import Generic, GenericAnimation, GenericPhysics, GenericPhysicsAnimaton
 from settings import *
+from profiler import profiler
+from collision import IndexedGroup
 
 
-class CameraGroup(pygame.sprite.Group):
+class CameraGroup(IndexedGroup):
     def __init__(self, debug_mode=False):
         super().__init__()
         self.display_surface = pygame.display.get_surface()
         self.offset = pygame.math.Vector2()
+        self.view_rect = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
         self.debug_mode = debug_mode
 
-    def custom_draw(self, player):
-        self.offset.x = player.rect.centerx - SCREEN_WIDTH / 2
-        self.offset.y = player.rect.centery - SCREEN_HEIGHT / 2
+        # render queue: sprites bucketed by z and kept sorted by y-axis
+        self.layers = {}
+        self.layer_keys = {}
+        self.layer_reach = {}
+        self.sprite_layers = {}
+        self.dirty_layers = set()
+
+        # render interpolation: centers of moving sprites at the start of the last simulation step
+        self.movers = {}
+        self.previous_centers = {}
+
+        # dirty rectangles: what was drawn last frame and screen areas to repaint next frame
+        self.last_drawn = {}
+        self.last_offset = None
+        self.invalidated = []
+
+        # low resolution rendering: the world is composed at 1/LOW_RES_SCALE and scaled up once per frame
+        if LOW_RES_SCALE:
+            size = (ceil(SCREEN_WIDTH / LOW_RES_SCALE) + 1, ceil(SCREEN_HEIGHT / LOW_RES_SCALE) + 1)
+            self.backbuffer = pygame.Surface(size).convert()
+            self.upscaled = pygame.Surface((size[0] * LOW_RES_SCALE, size[1] * LOW_RES_SCALE)).convert()
+            self.view_rect.size = self.upscaled.get_size()
+        # full size image -> the same image at low resolution, dropped with the image
+        self.low_res_images = weakref.WeakKeyDictionary()
+
+    def index(self, sprite):
+        # bucketed on the first draw after joining
+        self.layers.setdefault(sprite.z, []).append(sprite)
+        self.sprite_layers[sprite] = sprite.z
+        self.dirty_layers.add(sprite.z)
+
+    def unindex(self, sprite):
+        self.movers.pop(sprite, None)
+        self.previous_centers.pop(sprite, None)
+        if sprite in self.last_drawn:
+            self.invalidated.append(self.last_drawn.pop(sprite)[1])
+        if sprite in self.sprite_layers:
+            z = self.sprite_layers.pop(sprite)
+            self.layers[z].remove(sprite)
+            self.dirty_layers.add(z)
+
+    def move_sprite(self, sprite):
+        # called by movable sprites after they change their rect
+        self.movers[sprite] = None
+        if sprite in self.sprite_layers:
+            self.dirty_layers.add(self.sprite_layers[sprite])
+
+    def begin_step(self):
+        self.previous_centers = {sprite: sprite.rect.center for sprite in self.movers}
+
+    def get_render_center(self, sprite, alpha):
+        previous = self.previous_centers.get(sprite)
+        if previous is None or alpha >= 1:
+            return sprite.rect.center
+
+        return (previous[0] + (sprite.rect.centerx - previous[0]) * alpha,
+                previous[1] + (sprite.rect.centery - previous[1]) * alpha)
+
+    def sort_layer(self, z):
+        sprites = self.layers[z]
+        sprites.sort(key=lambda sprite: sprite.rect.centery)  # sorted by y-axis
+        self.layer_keys[z] = [sprite.rect.centery for sprite in sprites]
+        self.layer_reach[z] = max((sprite.rect.height for sprite in sprites), default=0) // 2 + 1
+
+    def get_visible_sprites(self, z):
+        sprites = self.layers.get(z)
+        if not sprites:
+            return []
+
+        if z in self.dirty_layers:
+            self.sort_layer(z)
+            self.dirty_layers.discard(z)
+
+        # only sprites whose centery is within reach of the view can overlap it
+        keys = self.layer_keys[z]
+        reach = self.layer_reach[z]
+        start = bisect_left(keys, self.view_rect.top - reach)
+        end = bisect_right(keys, self.view_rect.bottom + reach)
+        return [sprite for sprite in sprites[start:end] if sprite.rect.colliderect(self.view_rect)]
+
+    def update_offset(self, player, alpha):
+        # alpha is how far rendering is between the previous and the current simulation step
+        player_center = self.get_render_center(player, alpha)
+        self.offset.x = player_center[0] - SCREEN_WIDTH / 2
+        self.offset.y = player_center[1] - SCREEN_HEIGHT / 2
+        self.view_rect.topleft = (self.offset.x, self.offset.y)
+
+    def get_draw_list(self, alpha):
+        if self.pending:
+            self.flush()
+
+        draw_list = []
         for layer in LAYERS.values():
-            for sprite in sorted(self.sprites(), key=lambda sprite: sprite.rect.centery):  # sorted by y-axis
-                if sprite.z == layer:
-                    offset_rect = sprite.rect.copy()
-                    offset_rect.center -= self.offset
-                    self.display_surface.blit(sprite.image, offset_rect)
-
-                    if self.debug_mode:
-
-                        if sprite == player:
-                            pygame.draw.rect(self.display_surface,'red', offset_rect, 5)
-                            hitbox_rect = player.hitbox.copy()
-                            hitbox_rect.center = offset_rect.center
-                            pygame.draw.rect(self.display_surface, 'green', hitbox_rect, 5)
-
-                        if isinstance(sprite, Generic):
-                            hitbox_rect = sprite.hitbox.copy()
-                            hitbox_rect.center = offset_rect.center
-                            pygame.draw.rect(self.display_surface, 'green', hitbox_rect, 5)
-
-                        if isinstance(sprite, GenericAnimation):
-                            hitbox_rect = sprite.hitbox.copy()
-                            hitbox_rect.center = offset_rect.center
-                            pygame.draw.rect(self.display_surface, 'yellow', hitbox_rect, 5)
-
-                        if isinstance(sprite, GenericPhysics):
-                            hitbox_rect = sprite.hitbox.copy()
-                            hitbox_rect.center = offset_rect.center
-                            pygame.draw.rect(self.display_surface, 'purple', hitbox_rect, 5)
-
-                        if isinstance(sprite, GenericPhysicsAnimaton):
-                            hitbox_rect = sprite.hitbox.copy()
-                            hitbox_rect.center = offset_rect.center
-                            pygame.draw.rect(self.display_surface, 'pink', hitbox_rect, 5)
\ No newline at end of file
+            for sprite in self.get_visible_sprites(layer):
+                offset_rect = sprite.rect.copy()
+                offset_rect.center = self.get_render_center(sprite, alpha) - self.offset
+                draw_list.append((sprite, sprite.image, offset_rect))
+        return draw_list
+
+    def custom_draw(self, player, alpha=1.0):
+        self.update_offset(player, alpha)
+        self.blit_draw_list(self.get_draw_list(alpha), player)
+
+    def blit_draw_list(self, draw_list, player):
+        profiler.count('blits', len(draw_list))
+
+        if not self.debug_mode:
+            # one call for the whole frame instead of one per sprite
+            self.display_surface.blits([(image, offset_rect) for _, image, offset_rect in draw_list], doreturn=False)
+            return
+
+        for sprite, image, offset_rect in draw_list:
+            self.display_surface.blit(image, offset_rect)
+            self.draw_debug(sprite, offset_rect, player)
+
+    def get_low_res_image(self, sprite):
+        # tile chunks bake their own from the unscaled tiles, anything else is shrunk from its full size image
+        if hasattr(sprite, 'get_low_res_image'):
+            return sprite.get_low_res_image()
+
+        image = sprite.image
+        low_res_image = self.low_res_images.get(image)
+        if low_res_image is None:
+            size = (max(1, round(image.get_width() / LOW_RES_SCALE)), max(1, round(image.get_height() / LOW_RES_SCALE)))
+            low_res_image = pygame.transform.scale(image, size)
+            self.low_res_images[image] = low_res_image
+        return low_res_image
+
+    def low_res_draw(self, player, alpha=1.0):
+        # sprites are placed on whole low resolution pixels, the camera keeps its full resolution position
+        # by shifting the upscaled frame, so scrolling stays smooth
+        self.update_offset(player, alpha)
+        if self.pending:
+            self.flush()
+
+        origin_x, origin_y = floor(self.offset.x / LOW_RES_SCALE), floor(self.offset.y / LOW_RES_SCALE)
+        self.view_rect.topleft = (origin_x * LOW_RES_SCALE, origin_y * LOW_RES_SCALE)
+        shift = (round(self.offset.x) - self.view_rect.x, round(self.offset.y) - self.view_rect.y)
+
+        self.backbuffer.fill('Black')
+        blits = []
+        for layer in LAYERS.values():
+            for sprite in self.get_visible_sprites(layer):
+                center_x, center_y = self.get_render_center(sprite, alpha)
+                pos = (round((center_x - sprite.rect.width // 2) / LOW_RES_SCALE) - origin_x,
+                       round((center_y - sprite.rect.height // 2) / LOW_RES_SCALE) - origin_y)
+                blits.append((self.get_low_res_image(sprite), pos))
+
+        self.backbuffer.blits(blits, doreturn=False)
+        profiler.count('blits', len(blits))
+
+        pygame.transform.scale(self.backbuffer, self.upscaled.get_size(), self.upscaled)
+        self.display_surface.blit(self.upscaled, (-shift[0], -shift[1]))
+
+    def invalidate(self, rect=None):
+        # repaints a screen area next frame, or the whole screen without a rect
+        if rect is None:
+            self.last_offset = None
+        else:
+            self.invalidated.append(pygame.Rect(rect))
+
+    def dirty_draw(self, player, alpha=1.0):
+        # redraws only screen areas whose sprites changed image or position, returns them for display.update
+        self.update_offset(player, alpha)
+        draw_list = self.get_draw_list(alpha)
+        offset = (self.offset.x, self.offset.y)
+
+        if offset != self.last_offset or self.debug_mode:
+            self.last_offset = offset
+            self.last_drawn = {sprite: (image, offset_rect) for sprite, image, offset_rect in draw_list}
+            self.invalidated = []
+            self.display_surface.fill('Black')
+            self.blit_draw_list(draw_list, player)
+            return [self.display_surface.get_rect()]
+
+        dirty_rects = self.invalidated
+        self.invalidated = []
+        drawn = {}
+        for sprite, image, offset_rect in draw_list:
+            drawn[sprite] = (image, offset_rect)
+            last = self.last_drawn.pop(sprite, None)
+            if last is None:
+                dirty_rects.append(offset_rect)
+            elif last[0] is not image or last[1] != offset_rect:
+                dirty_rects.append(offset_rect)
+                dirty_rects.append(last[1])
+
+        # whatever is left was drawn last frame but is gone now
+        dirty_rects.extend(last[1] for last in self.last_drawn.values())
+        self.last_drawn = drawn
+
+        dirty_rects = self.merge_rects(dirty_rects)
+        for dirty_rect in dirty_rects:
+            self.display_surface.set_clip(dirty_rect)
+            self.display_surface.fill('Black')
+            blits = [(image, offset_rect) for _, image, offset_rect in draw_list if offset_rect.colliderect(dirty_rect)]
+            self.display_surface.blits(blits, doreturn=False)
+            profiler.count('blits', len(blits))
+        self.display_surface.set_clip(None)
+
+        return dirty_rects
+
+    @staticmethod
+    def merge_rects(rects):
+        merged = []
+        for rect in rects:
+            rect = rect.copy()
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def draw_debug(self, sprite, offset_rect, player):
+        if sprite == player:
+            pygame.draw.rect(self.display_surface,'red', offset_rect, 5)
+            hitbox_rect = player.hitbox.copy()
+            hitbox_rect.center = offset_rect.center
+            pygame.draw.rect(self.display_surface, 'green', hitbox_rect, 5)
+
+        if isinstance(sprite, Generic):
+            hitbox_rect = sprite.hitbox.copy()
+            hitbox_rect.center = offset_rect.center
+            pygame.draw.rect(self.display_surface, 'green', hitbox_rect, 5)
+
+        if isinstance(sprite, GenericAnimation):
+            hitbox_rect = sprite.hitbox.copy()
+            hitbox_rect.center = offset_rect.center
+            pygame.draw.rect(self.display_surface, 'yellow', hitbox_rect, 5)
+
+        if isinstance(sprite, GenericPhysics):
+            hitbox_rect = sprite.hitbox.copy()
+            hitbox_rect.center = offset_rect.center
+            pygame.draw.rect(self.display_surface, 'purple', hitbox_rect, 5)
+
+        if isinstance(sprite, GenericPhysicsAnimaton):
+            hitbox_rect = sprite.hitbox.copy()
+            hitbox_rect.center = offset_rect.center
+            pygame.draw.rect(self.display_surface, 'pink', hitbox_rect, 5)
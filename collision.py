@@ -0,0 +1,144 @@
+import pygame
+from bisect import bisect_left, bisect_right
+from settings import COLLISION_CELL_SIZE
+from profiler import profiler
+
+
+class IndexedGroup(pygame.sprite.Group):
+    # sprites join their groups before their hitbox, rect or z exist, so they wait in pending until the group
+    # first needs them and flushes: index files a sprite away, unindex forgets it and must accept one never indexed
+    def __init__(self):
+        super().__init__()
+        self.pending = {}
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.pending[sprite] = None
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.pending.pop(sprite, None)
+        self.unindex(sprite)
+
+    def flush(self):
+        for sprite in self.pending:
+            self.index(sprite)
+        self.pending.clear()
+
+    def index(self, sprite):
+        raise NotImplementedError
+
+    def unindex(self, sprite):
+        raise NotImplementedError
+
+
+class CollisionGroup(IndexedGroup):
+    def __init__(self, cell_size=COLLISION_CELL_SIZE):
+        super().__init__()
+        self.cell_size = cell_size
+        self.cells = {}
+        self.sprite_cells = {}
+        # solid tile layers answer for their own cells
+        self.tile_layers = []
+
+    def add_layer(self, tile_layer):
+        self.tile_layers.append(tile_layer)
+
+    @staticmethod
+    def get_bounds(sprite):
+        return sprite.hitbox if hasattr(sprite, 'hitbox') else sprite.rect
+
+    def get_cells(self, rect):
+        size = self.cell_size
+        right = max(rect.right - 1, rect.left)
+        bottom = max(rect.bottom - 1, rect.top)
+        return [(x, y)
+                for x in range(rect.left // size, right // size + 1)
+                for y in range(rect.top // size, bottom // size + 1)]
+
+    def index(self, sprite):
+        cells = self.get_cells(self.get_bounds(sprite))
+        for cell in cells:
+            self.cells.setdefault(cell, {})[sprite] = None
+        self.sprite_cells[sprite] = cells
+
+    def unindex(self, sprite):
+        for cell in self.sprite_cells.pop(sprite, ()):
+            bucket = self.cells[cell]
+            del bucket[sprite]
+            if not bucket:
+                del self.cells[cell]
+
+    def move_sprite(self, sprite):
+        # called by movable sprites after they change their hitbox
+        if sprite not in self.sprite_cells:
+            return
+
+        cells = self.get_cells(self.get_bounds(sprite))
+        if cells != self.sprite_cells[sprite]:
+            self.unindex(sprite)
+            self.index(sprite)
+
+    def query(self, rect):
+        profiler.count('collision_queries')
+        if self.pending:
+            self.flush()
+
+        found = {}
+        for cell in self.get_cells(rect):
+            bucket = self.cells.get(cell)
+            if bucket:
+                found.update(bucket)
+
+        tiles = [tile for tile_layer in self.tile_layers for tile in tile_layer.query(rect)]
+        return tiles + list(found) if tiles else list(found)
+
+
+class PhysicsGroup(IndexedGroup):
+    # sweep and prune broadphase: dynamic bodies kept sorted by the left edge of their hitbox
+    def __init__(self):
+        super().__init__()
+        self.bodies = []
+        self.lefts = []
+        self.body_lefts = {}
+        self.max_width = 0
+
+    def index(self, sprite):
+        self.insert_body(sprite)
+
+    def unindex(self, sprite):
+        if sprite in self.body_lefts:
+            self.remove_body(sprite)
+
+    def insert_body(self, sprite):
+        left = sprite.hitbox.left
+        index = bisect_right(self.lefts, left)
+        self.lefts.insert(index, left)
+        self.bodies.insert(index, sprite)
+        self.body_lefts[sprite] = left
+        self.max_width = max(self.max_width, sprite.hitbox.width)
+
+    def remove_body(self, sprite):
+        left = self.body_lefts.pop(sprite)
+        index = bisect_left(self.lefts, left)
+        while self.bodies[index] is not sprite:
+            index += 1
+        del self.lefts[index]
+        del self.bodies[index]
+
+    def move_sprite(self, sprite):
+        # bodies move a little per step, so re-inserting the one that moved keeps the order
+        if sprite in self.body_lefts and self.body_lefts[sprite] != sprite.hitbox.left:
+            self.remove_body(sprite)
+            self.insert_body(sprite)
+
+    def query(self, rect):
+        profiler.count('collision_queries')
+        if self.pending:
+            self.flush()
+
+        # bodies starting further left than the widest body can not reach the rect
+        start = bisect_left(self.lefts, rect.left - self.max_width)
+        end = bisect_left(self.lefts, rect.right)
+        return [sprite for sprite in self.bodies[start:end]
+                if sprite.hitbox.right > rect.left and sprite.hitbox.top < rect.bottom and sprite.hitbox.bottom > rect.top]
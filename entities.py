@@ -0,0 +1,241 @@
+from settings import ENTITY_FRICTION
+from profiler import profiler
+from collision import IndexedGroup
+
+# numpy is optional, without it Level keeps the plain PhysicsGroup
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SOLID = 1
+MOVING = 2
+# moved by a push this step, integration leaves it alone until the next one
+PUSHED = 4
+
+
+class EntityStore:
+    # struct of arrays for physics bodies: hitbox centers, velocities, hitbox boxes and flags, one row per body
+    def __init__(self, capacity=256):
+        self.count = 0
+        self.centers = np.zeros((capacity, 2))
+        self.velocities = np.zeros((capacity, 2))
+        self.sizes = np.zeros((capacity, 2), np.int32)
+        # left, top, right, bottom of each hitbox
+        self.boxes = np.zeros((capacity, 4), np.int32)
+        self.flags = np.zeros(capacity, np.uint8)
+        self.sprites = []
+        self.indices = {}
+
+    def grow(self):
+        capacity = len(self.flags) * 2
+        for name in ('centers', 'velocities', 'sizes', 'boxes', 'flags'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, sprite):
+        if self.count == len(self.flags):
+            self.grow()
+
+        index = self.count
+        self.count += 1
+        self.sprites.append(sprite)
+        self.indices[sprite] = index
+        self.velocities[index] = 0
+        self.flags[index] = SOLID
+        self.update_body(sprite)
+
+    def remove(self, sprite):
+        # the last row fills the gap
+        index = self.indices.pop(sprite)
+        last = self.count - 1
+        if index != last:
+            moved = self.sprites[last]
+            for array in (self.centers, self.velocities, self.sizes, self.boxes, self.flags):
+                array[index] = array[last]
+            self.sprites[index] = moved
+            self.indices[moved] = index
+        self.sprites.pop()
+        self.count = last
+
+    @staticmethod
+    def get_center(sprite):
+        # the float position of pushable props, their hitbox center is rounded
+        if hasattr(sprite, 'pos') and hasattr(sprite, 'hitbox_offset'):
+            return sprite.pos.x + sprite.hitbox_offset.x, sprite.pos.y + sprite.hitbox_offset.y
+        return sprite.hitbox.center
+
+    def update_body(self, sprite):
+        index = self.indices[sprite]
+        hitbox = sprite.hitbox
+        self.centers[index] = self.get_center(sprite)
+        self.sizes[index] = hitbox.size
+        self.boxes[index] = (hitbox.left, hitbox.top, hitbox.right, hitbox.bottom)
+
+    def set_velocity(self, sprite, velocity):
+        index = self.indices[sprite]
+        self.velocities[index] = velocity
+        if velocity[0] or velocity[1]:
+            self.flags[index] |= MOVING
+        else:
+            self.flags[index] &= 0xFF ^ MOVING
+
+    def query(self, rect):
+        # one vectorized AABB test against every body
+        boxes = self.boxes[:self.count]
+        mask = ((boxes[:, 0] < rect.right) & (boxes[:, 2] > rect.left) &
+                (boxes[:, 1] < rect.bottom) & (boxes[:, 3] > rect.top) &
+                (self.flags[:self.count] & SOLID).astype(bool))
+        return [self.sprites[index] for index in np.flatnonzero(mask)]
+
+    def overlap_pairs(self, indices):
+        # every body overlapping one of the given bodies in one step. Boxes are sorted by horizontal band,
+        # one band as tall as the tallest hitbox, then by left edge: an overlapping body sits in the same or a
+        # neighbouring band and starts within the widest hitbox of the left edge and before the right edge
+        boxes = self.boxes[:self.count].astype(np.int64)
+        band_height = max(1, int(self.sizes[:self.count, 1].max()))
+        max_width = int(self.sizes[:self.count, 0].max())
+        bands = boxes[:, 1] // band_height
+        keys = (bands << 32) + boxes[:, 0] + (1 << 31)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        a_parts, b_parts = [], []
+        for band_offset in (-1, 0, 1):
+            band_keys = ((bands[indices] + band_offset) << 32) + (1 << 31)
+            starts = np.searchsorted(sorted_keys, band_keys + boxes[indices, 0] - max_width, side='right')
+            counts = np.searchsorted(sorted_keys, band_keys + boxes[indices, 2], side='left') - starts
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            a_parts.append(np.repeat(indices, counts))
+            b_parts.append(order[np.repeat(starts, counts) + offsets])
+
+        a, b = np.concatenate(a_parts), np.concatenate(b_parts)
+        overlap = ((a != b) & (boxes[b, 2] > boxes[a, 0]) &
+                   (boxes[a, 1] < boxes[b, 3]) & (boxes[b, 1] < boxes[a, 3]))
+        return a[overlap], b[overlap]
+
+    def get_pair_keys(self, a, b):
+        # one integer per unordered pair, so pair sets can be compared with numpy set operations
+        return np.minimum(a, b) * self.count + np.maximum(a, b)
+
+    def set_boxes(self, indices):
+        half = self.sizes[indices] / 2
+        centers = np.rint(self.centers[indices])
+        self.boxes[indices, 0:2] = centers - np.floor(half)
+        self.boxes[indices, 2:4] = self.boxes[indices, 0:2] + self.sizes[indices]
+
+    @staticmethod
+    def get_solid_cells(tile_layer):
+        # the layer's grid viewed as a 2d array, shared with the TileLayer
+        cells = np.frombuffer(tile_layer.cells, dtype=np.dtype(f'u{tile_layer.cells.itemsize}'))
+        return cells.reshape(tile_layer.height, tile_layer.width)
+
+    def hits_tiles(self, indices, tile_layers):
+        # checks the cells under the four corners of each hitbox, bodies are not larger than a tile
+        blocked = np.zeros(len(indices), bool)
+        boxes = self.boxes[indices]
+        for tile_layer in tile_layers:
+            cells = self.get_solid_cells(tile_layer)
+            width, height = tile_layer.tile_size
+            for x in (boxes[:, 0], boxes[:, 2] - 1):
+                for y in (boxes[:, 1], boxes[:, 3] - 1):
+                    cell_x, cell_y = x // width, y // height
+                    inside = (cell_x >= 0) & (cell_x < tile_layer.width) & (cell_y >= 0) & (cell_y < tile_layer.height)
+                    solid = np.ones(len(indices), bool)
+                    solid[inside] = cells[cell_y[inside], cell_x[inside]] != 0
+                    blocked |= solid
+        return blocked
+
+    def integrate(self, dt, tile_layers=(), friction=ENTITY_FRICTION):
+        # moves every body with a velocity, one axis at a time, and returns the sprites that moved
+        flags = self.flags[:self.count]
+        moving = np.flatnonzero((flags & MOVING).astype(bool) & ~(flags & PUSHED).astype(bool))
+        flags &= 0xFF ^ PUSHED
+        if not len(moving):
+            return []
+
+        resting_pairs = self.get_pair_keys(*self.overlap_pairs(moving))
+        start = self.centers[moving].copy()
+        for axis in (0, 1):
+            previous = self.centers[moving, axis].copy()
+            self.centers[moving, axis] += self.velocities[moving, axis] * dt
+            self.set_boxes(moving)
+
+            hits = self.hits_tiles(moving, tile_layers)
+            blocked = moving[hits]
+            self.centers[blocked, axis] = previous[hits]
+            self.velocities[blocked, axis] = 0
+            self.set_boxes(blocked)
+
+        # bodies that slid into another one stop where they started this step, resting overlaps like
+        # props placed on tables are left alone. A body sent back can land on a neighbour that slid into its
+        # place, so the test repeats until no body is sent back, every round stops at least one more body
+        sent_back = np.zeros(0, moving.dtype)
+        while True:
+            touching = np.setdiff1d(self.get_pair_keys(*self.overlap_pairs(moving)), resting_pairs)
+            stopped = np.intersect1d(np.concatenate((touching // self.count, touching % self.count)), moving)
+            stopped = np.setdiff1d(stopped, sent_back)
+            if not len(stopped):
+                break
+            self.centers[stopped] = start[np.searchsorted(moving, stopped)]
+            self.velocities[stopped] = 0
+            self.set_boxes(stopped)
+            sent_back = np.union1d(sent_back, stopped)
+
+        self.velocities[moving] *= max(0.0, 1 - friction * dt)
+        resting = moving[np.abs(self.velocities[moving]).max(axis=1) < 1]
+        self.velocities[resting] = 0
+        self.flags[resting] &= 0xFF ^ MOVING
+
+        moved = moving[np.any(self.centers[moving] != start, axis=1)]
+        profiler.count('integrated_bodies', len(moving))
+        return self.write_back(moved)
+
+    def write_back(self, indices):
+        # copies the arrays back into the sprites' rects, which drawing and the scalar collision code read
+        sprites = []
+        for index, (left, top), (center_x, center_y) in zip(indices.tolist(), self.boxes[indices, 0:2].tolist(),
+                                                             self.centers[indices].tolist()):
+            sprite = self.sprites[index]
+            sprite.hitbox.topleft = (left, top)
+            sprite.rect.center = sprite.hitbox.center
+            if hasattr(sprite, 'pos'):
+                sprite.pos.update(center_x - sprite.hitbox_offset.x, center_y - sprite.hitbox_offset.y)
+            sprites.append(sprite)
+        return sprites
+
+
+class EntityGroup(IndexedGroup):
+    # PhysicsGroup backed by an EntityStore: vectorized queries, and pushed bodies keep sliding until friction stops them
+    def __init__(self):
+        super().__init__()
+        self.store = EntityStore()
+
+    def index(self, sprite):
+        self.store.add(sprite)
+
+    def unindex(self, sprite):
+        if sprite in self.store.indices:
+            self.store.remove(sprite)
+
+    def move_sprite(self, sprite):
+        # a push moved the body, it carries on with the pusher's speed
+        if sprite in self.store.indices:
+            self.store.update_body(sprite)
+            self.store.set_velocity(sprite, (sprite.direction.x * sprite.weight, sprite.direction.y * sprite.weight))
+            self.store.flags[self.store.indices[sprite]] |= PUSHED
+
+    def query(self, rect):
+        profiler.count('collision_queries')
+        if self.pending:
+            self.flush()
+        return self.store.query(rect)
+
+    def update_bodies(self, dt, tile_layers=()):
+        if self.pending:
+            self.flush()
+
+        for sprite in self.store.integrate(dt, tile_layers):
+            sprite.visible_sprites.move_sprite(sprite)
@@ -1,14 +1,25 @@
 import pygame
 from settings import *
 from player import Player
-from pytmx.util_pygame import load_pygame
 from support import *
 from camera import CameraGroup
-from sprites import Generic, GenericAnimation, GenericPhysics, Door, Chest
+from tilemap import TileLayer
+from level_cache import LevelCache
+from streaming import LevelStreamer
+from profiler import profiler, ProfilerOverlay
+from collision import CollisionGroup, PhysicsGroup
+from entities import EntityGroup, np
+from sprites import Generic, GenericAnimation, GenericPhysics, Door, Chest, TileChunk
 
 
 class Level:
-    def __init__(self):
+    def __init__(self, level_path=LEVEL_PATH['first_level'], data_path='level_data.json', level_assets=None, deferred=False):
+        self.level_path = level_path
+        self.data_path = data_path
+        # (tmx_data, level_data) prepared by a LevelLoader, read here when None
+        self.level_assets = level_assets
+        # what this level rolls, the same every time it is built in a session
+        self.rng = rng.for_level(level_path)
         self.clock = None
         self.inventory = None
         self.player = None
@@ -16,11 +27,20 @@ class Level:
         # sprite groups
         debug_mode = False
         self.all_sprites = CameraGroup(debug_mode)
-        self.collision_sprites = pygame.sprite.Group()
-        self.physics_sprites = pygame.sprite.Group()
+        self.collision_sprites = CollisionGroup()
+        # the numpy entity store is optional, the sweep and prune group needs nothing extra
+        self.physics_sprites = EntityGroup() if ENTITY_STORE and np else PhysicsGroup()
 
         # objects
         self.objects = []
+        self.tile_layers = {}
+        self.tile_chunks = {}
+        self.streamer = LevelStreamer(self) if LEVEL_STREAMING else None
+
+        # doors: (trigger rect, target level path), read from the map so streamed levels know them up front
+        self.doors = []
+        self.door_inside = None
+        self.entered_door = None
 
         self.CLASS_MAP = {
             'Generic': Generic,
@@ -36,20 +56,29 @@ class Level:
             'physics_sprites': self.physics_sprites
         }
 
+        # timers run on simulation time, so they stop while the game is not updated
+        self.timers = TimerScheduler()
+
         # delay
-        self.window_delay = 200
+        self.window_delay = 0.2
 
         # logic
-        self.last_inv_toggle_time = 0
+        self.inv_toggle_ready = True
         self.inv_active = False
 
+        # profiling
+        self.profiler_overlay = None
+        self.profiler_active = False
+
+        # screen areas changed by the last draw, None when the whole screen was redrawn
+        self.dirty_rects = None
+
         # music
-        self.music = {
-            'first_level': MUSIC_PATH['first_level']
-        }
-        self.sound_manager = SoundManager(self.music)
+        self.music = MUSIC_PATH['first_level']
 
-        self.setup()
+        # a deferred level is built by whoever runs build_steps, a few steps per frame
+        if not deferred:
+            self.setup()
 
     def setup(self):
         # self.player = Player(
@@ -65,11 +94,15 @@ class Level:
         #         self.player = Player(
         #             pos = (obj.x, obj.y),
         #             group = self.all_sprites)
-        self.load_level_data('level_data.json')
+        self.load_level_data(self.level_path, self.data_path)
 
-    def load_level_data(self, data_path):
-        tmx_data = load_pygame('tiled/level1_1.tmx')
-        level_data = FileManager.get_json_data(data_path)
+    def load_level_data(self, level_path, data_path):
+        for _ in self.build_steps(level_path, data_path):
+            pass
+
+    def build_steps(self, level_path, data_path):
+        # builds the level one layer or chunk at a time, yielding after each so a loader can spread it over frames
+        tmx_data, level_data = self.level_assets or LevelCache.load(level_path, data_path)
 
         tile_id = 0
 
@@ -78,19 +111,47 @@ class Level:
             groups = []
 
             for group in layer_info['groups']:
+                # tile layers are drawn as baked chunks and collide through their cell grid instead of per-tile sprites
+                if group in ('all_sprites', 'collision_sprites'):
+                    continue
                 groups.append(self.GROUP_MAP[group])
 
             display_layer = layer_info['display_layer']
-            title_class = self.CLASS_MAP[layer_info['class']]
-            Level.populate_world_tiles(tile_id, tmx_data, tmx_layer_name, title_class, groups, LAYERS[display_layer])
+            rendered = 'all_sprites' in layer_info['groups']
+            tile_layer = TileLayer.from_tmx(tmx_data.get_layer_by_name(tmx_layer_name), LAYERS[display_layer], (6, 6),
+                                            'collision_sprites' in layer_info['groups'])
+            self.tile_layers[tmx_layer_name] = tile_layer
+            if tile_layer.solid:
+                self.collision_sprites.add_layer(tile_layer)
+
+            if self.streamer:
+                title_class = self.CLASS_MAP[layer_info['class']]
+                self.streamer.add_tile_layer(tile_id, tile_layer, title_class, groups, rendered)
+                tile_id += 1
+                yield
+                continue
+
+            if rendered:
+                # baking is the slow part of a tile layer, so every chunk is a step of its own
+                chunks = Level.populate_world_chunks(tile_layer, self.all_sprites)
+                self.tile_chunks[tmx_layer_name] = chunks
+                for chunk in chunks.values():
+                    chunk.prepare()
+                    yield
+
+            if groups:
+                title_class = self.CLASS_MAP[layer_info['class']]
+                Level.populate_world_tiles(tile_id, tmx_data, tmx_layer_name, title_class, groups, LAYERS[display_layer])
 
             tile_id += 1
+            yield
 
         for obj_info in level_data["objects"]:
             tmx_layer_name = obj_info['name']
 
             if tmx_layer_name == 'player':
                 self.spawn_player(tmx_data, tmx_layer_name)
+                yield
                 continue
 
             sprite_groups = []
@@ -100,18 +161,80 @@ class Level:
 
             display_layer = obj_info['display_layer']
             obj_class = self.CLASS_MAP[obj_info['class']]
+            if obj_class is Door:
+                self.doors.extend(Level.get_doors(tmx_data, tmx_layer_name))
 
-            self.objects.extend(Level.populate_world_objects(tile_id, tmx_data, tmx_layer_name, obj_class, sprite_groups, LAYERS[display_layer]))
+            if self.streamer:
+                self.streamer.add_object_layer(tile_id, tmx_data, tmx_layer_name, obj_class, sprite_groups, LAYERS[display_layer])
+                tile_id += 1
+                yield
+                continue
+
+            objects = Level.populate_world_objects(tile_id, tmx_data, tmx_layer_name, obj_class, sprite_groups, LAYERS[display_layer])
+            for obj in objects:
+                if isinstance(obj, Chest):
+                    obj.generate_loot(self.rng)
+            self.objects.extend(objects)
 
             tile_id += 1
+            yield
+
+        # the player spawns before any chunk exists, so the area around it is built now, a chunk per step
+        if self.streamer:
+            for chunk_pos in self.streamer.get_area(self.streamer.get_chunk(self.player.rect.center), STREAM_RADIUS):
+                self.streamer.load_chunk(chunk_pos)
+                yield
 
     def spawn_player(self, tmx_data, tmx_layer_name):
         for obj in tmx_data.get_layer_by_name(tmx_layer_name):
             if obj.name == 'start':
                 self.player = Player((obj.x, obj.y), self.all_sprites, self.collision_sprites, self.physics_sprites)
 
-        self.sound_manager.play_sound('first_level')
-        self.sound_manager.set_volume_to_sound('first_level', 0.2)
+    @staticmethod
+    def get_doors(tmx_data, tmx_layer, scale=(6, 6)):
+        doors = []
+        for obj in tmx_data.get_layer_by_name(tmx_layer):
+            target = obj.properties.get('target')
+            if target:
+                door_rect = pygame.Rect(obj.x * scale[0], obj.y * scale[1], obj.width * scale[0], obj.height * scale[1])
+                doors.append((door_rect.inflate(DOOR_REACH * 2, DOOR_REACH * 2), target))
+        return doors
+
+    def get_door(self):
+        for door in self.doors:
+            if door[0].colliderect(self.player.hitbox):
+                return door
+        return None
+
+    def get_nearest_door_target(self):
+        if not self.doors:
+            return None
+        center = pygame.math.Vector2(self.player.hitbox.center)
+        return min(self.doors, key=lambda door: center.distance_squared_to(door[0].center))[1]
+
+    def update_doors(self):
+        # a door triggers when the player steps onto it, not while it keeps standing there
+        door = self.get_door()
+        self.entered_door = door if door is not self.door_inside else None
+        self.door_inside = door
+
+    def activate(self, previous_path=None):
+        # makes the level the current one, freshly built or back from the level pool
+        if previous_path:
+            for door_rect, target in self.doors:
+                if target == previous_path:
+                    # just below the door, inside its reach
+                    self.player.place((door_rect.centerx, door_rect.bottom - DOOR_REACH + self.player.hitbox.height // 2))
+                    break
+
+        # arriving on a door does not take the player straight back
+        self.door_inside = self.get_door()
+        self.entered_door = None
+        self.all_sprites.begin_step()
+        self.all_sprites.invalidate()
+        if self.streamer:
+            self.streamer.update(self.player)
+        music_player.play(self.music)
 
     @staticmethod
     def populate_world_tiles(tile_id, tmx_data, tmx_layer, tile_class, groups, z, scale=(6, 6)):
@@ -120,6 +243,32 @@ class Level:
         for x, y, surf in layer.tiles():
             tile_class(tile_id, (x * TILE_SIZE, y * TILE_SIZE), surf, groups, z, scale, name=tmx_layer)
 
+    @staticmethod
+    def populate_world_chunks(tile_layer, group):
+        chunks = {}
+        for x, y, _ in tile_layer.get_tiles(scaled=False):
+            chunk_pos = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+            if chunk_pos not in chunks:
+                chunks[chunk_pos] = TileChunk(chunk_pos, tile_layer, group)
+
+        # not baked yet, build_steps prepares them one by one
+        return chunks
+
+    def set_tile(self, tmx_layer, pos, surf):
+        # the owning chunk is rebuilt the next time it is drawn, collision sees the change right away
+        self.tile_layers[tmx_layer].set_tile(pos[0], pos[1], surf)
+
+        chunks = self.tile_chunks.get(tmx_layer)
+        if chunks is None:
+            return
+
+        chunk_pos = (pos[0] // CHUNK_SIZE, pos[1] // CHUNK_SIZE)
+        if chunk_pos in chunks:
+            chunks[chunk_pos].mark_dirty()
+        elif not self.streamer:
+            # chunks that are not loaded pick the change up when they stream in
+            chunks[chunk_pos] = TileChunk(chunk_pos, self.tile_layers[tmx_layer], self.all_sprites)
+
     @staticmethod
     def populate_world_objects(obj_id, tmx_data, tmx_layer, obj_class, groups, z, scale=(6, 6)):
         layer = tmx_data.get_layer_by_name(tmx_layer)
@@ -138,17 +287,66 @@ class Level:
         return objects_list
 
     def toggle_inventory(self):
-        current_time = pygame.time.get_ticks()
-        if current_time - self.last_inv_toggle_time > self.window_delay:
+        if self.inv_toggle_ready:
             self.inv_active = not self.inv_active
-            self.last_inv_toggle_time = current_time
-
-    def run(self, dt):
-        # drawing logic
-        self.display_surface.fill('Black')
-        self.all_sprites.custom_draw(self.player)
-        self.player.update(dt)
-        self.sound_manager.update()
-
-        for obj in self.objects:
-            obj.update(dt)
\ No newline at end of file
+            self.inv_toggle_ready = False
+            self.timers.schedule(self.window_delay, self.enable_inventory_toggle)
+
+    def enable_inventory_toggle(self):
+        self.inv_toggle_ready = True
+
+    def toggle_profiler(self):
+        if not self.profiler_overlay:
+            self.profiler_overlay = ProfilerOverlay(profiler)
+        self.profiler_active = not self.profiler_active
+        self.all_sprites.invalidate()
+
+    def draw(self, alpha=1.0):
+        if LOW_RES_SCALE:
+            # the whole frame is upscaled every time, so dirty rectangles do not apply
+            with profiler.scope('draw'):
+                self.all_sprites.low_res_draw(self.player, alpha)
+        elif DIRTY_RECTS:
+            with profiler.scope('draw'):
+                self.dirty_rects = self.all_sprites.dirty_draw(self.player, alpha)
+        else:
+            with profiler.scope('fill'):
+                self.display_surface.fill('Black')
+            with profiler.scope('draw'):
+                self.all_sprites.custom_draw(self.player, alpha)
+
+    def draw_overlay(self):
+        if self.profiler_active:
+            overlay_rect = self.profiler_overlay.draw()
+
+            # the overlay covers the world, so its area is repainted next frame
+            if self.dirty_rects is not None and overlay_rect:
+                self.dirty_rects.append(overlay_rect)
+                self.all_sprites.invalidate(overlay_rect)
+
+    def present(self):
+        if self.dirty_rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(self.dirty_rects)
+
+    def update_objects(self, dt):
+        # props have no per tick work of their own, animations read the shared clock and pushes happen on contact
+        if isinstance(self.physics_sprites, EntityGroup):
+            self.physics_sprites.update_bodies(dt, self.collision_sprites.tile_layers)
+
+    def update(self, dt):
+        # one simulation step
+        self.all_sprites.begin_step()
+        self.timers.update(dt)
+        animation_clock.update(dt)
+        if self.streamer:
+            with profiler.scope('streaming'):
+                self.streamer.update(self.player)
+        with profiler.scope('player'):
+            self.player.update(dt)
+        with profiler.scope('audio'):
+            music_player.update(dt)
+        with profiler.scope('objects'):
+            self.update_objects(dt)
+        self.update_doors()
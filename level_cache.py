@@ -0,0 +1,250 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+from array import array
+import pygame
+from pytmx import TiledMap
+from pytmx.util_pygame import load_pygame, handle_transformation
+from settings import LEVEL_CACHE_DIR, LOW_RES_SCALE
+from support import FileManager, ScaledSurfaces
+
+CACHE_MAGIC = b'RPLC'
+CACHE_VERSION = 4
+HEADER = struct.Struct('<4sII')
+
+
+class CompiledTileLayer:
+    def __init__(self, name, width, height, grid, images):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.grid = grid
+        self.images = images
+
+    def tiles(self):
+        width = self.width
+        images = self.images
+        for index, image_index in enumerate(self.grid):
+            if image_index:
+                yield index % width, index // width, images[image_index - 1]
+
+
+class CompiledObject:
+    def __init__(self, name, x, y, width, height, image, properties=None):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.image = image
+        self.properties = properties or {}
+
+
+class CompiledMap:
+    # stands in for pytmx's TiledMap, only exposing what Level reads from it
+    def __init__(self, layers):
+        self.layers = layers
+
+    def get_layer_by_name(self, name):
+        return self.layers[name]
+
+
+class LevelCache:
+    # compiles a tmx map and its level data into one file: index grids, object records and tile atlases
+    @staticmethod
+    def load(level_path, data_path, scale=(6, 6)):
+        return LevelCache.finish(LevelCache.fetch(level_path, data_path, scale), level_path, data_path, scale)
+
+    @staticmethod
+    def get_key(level_path, data_path):
+        # maps with the same file name in different folders, or built with other level data, are different caches
+        return [os.path.normcase(os.path.abspath(level_path)), os.path.normcase(os.path.abspath(data_path))]
+
+    @staticmethod
+    def get_cache_path(level_path, data_path):
+        digest = hashlib.sha1('\n'.join(LevelCache.get_key(level_path, data_path)).encode()).hexdigest()[:12]
+        return os.path.join(LEVEL_CACHE_DIR, f'{os.path.basename(level_path)}-{digest}.lvlc')
+
+    @staticmethod
+    def fetch(level_path, data_path, scale=(6, 6)):
+        # file reads, tmx parsing, decoding and compression, so it can run on a loader thread
+        if not LEVEL_CACHE_DIR:
+            return None
+
+        cache_path = LevelCache.get_cache_path(level_path, data_path)
+        if os.path.exists(cache_path):
+            try:
+                cached = LevelCache.read(cache_path)
+                if cached[0]['key'] != LevelCache.get_key(level_path, data_path):
+                    raise ValueError('compiled from another map or level data')
+                # the tilesets and images were listed when compiling, a changed map is newer than the cache anyway
+                if LevelCache.is_fresh(cache_path, [level_path, data_path] + cached[0]['sources']):
+                    return cached
+            except (OSError, ValueError, KeyError, struct.error, zlib.error) as error:
+                logging.warning(f'rebuilding level cache {cache_path}: {error}')
+        return LevelCache.compile(level_path, data_path, cache_path, scale)
+
+    @staticmethod
+    def finish(cached, level_path, data_path, scale=(6, 6)):
+        # builds the surfaces, which has to happen on the main thread
+        if not LEVEL_CACHE_DIR:
+            return load_pygame(level_path), FileManager.get_json_data(data_path)
+        return LevelCache.build(cached, scale)
+
+    @staticmethod
+    def image_loader(filename, colorkey, **kwargs):
+        # pytmx's pygame loader converts every tile for the display, the atlas only needs their pixels,
+        # so compiling can stay off the main thread
+        if colorkey:
+            colorkey = pygame.Color(f'#{colorkey}')
+        image = pygame.image.load(filename)
+
+        def load_image(rect=None, flags=None):
+            tile = image.subsurface(rect) if rect else image.copy()
+            if flags:
+                tile = handle_transformation(tile, flags)
+            if colorkey:
+                tile.set_colorkey(colorkey)
+            return tile
+
+        return load_image
+
+    @staticmethod
+    def get_sources(level_path):
+        # the map's external tilesets and every image they reference
+        sources = []
+        level_dir = os.path.dirname(level_path)
+        for tileset in ET.parse(level_path).getroot().iter('tileset'):
+            if not tileset.get('source'):
+                continue
+            tileset_path = os.path.join(level_dir, tileset.get('source'))
+            sources.append(tileset_path)
+            for image in ET.parse(tileset_path).getroot().iter('image'):
+                sources.append(os.path.join(os.path.dirname(tileset_path), image.get('source')))
+        return sources
+
+    @staticmethod
+    def is_fresh(cache_path, sources):
+        cache_time = os.path.getmtime(cache_path)
+        return all(os.path.exists(source) and os.path.getmtime(source) < cache_time for source in sources)
+
+    @staticmethod
+    def compile(level_path, data_path, cache_path, scale):
+        # writes the cache file and returns its contents the way read does
+        tmx_data = TiledMap(level_path, image_loader=LevelCache.image_loader)
+        level_data = FileManager.get_json_data(data_path)
+
+        images = {}
+
+        def image_index(surf):
+            if surf not in images:
+                images[surf] = len(images)
+            return images[surf] + 1
+
+        layers = []
+        blobs = []
+        for layer_info in level_data['layers']:
+            layer = tmx_data.get_layer_by_name(layer_info['name'])
+            grid = array('I', bytes(4 * layer.width * layer.height))
+            for x, y, surf in layer.tiles():
+                grid[y * layer.width + x] = image_index(surf)
+            layers.append({'name': layer.name, 'width': layer.width, 'height': layer.height})
+            blobs.append(grid.tobytes())
+
+        object_layers = []
+        for obj_info in level_data['objects']:
+            objects = []
+            for obj in tmx_data.get_layer_by_name(obj_info['name']):
+                objects.append([obj.name, obj.x, obj.y, obj.width, obj.height,
+                                image_index(obj.image) if obj.image else 0, dict(obj.properties)])
+            object_layers.append({'name': obj_info['name'], 'objects': objects})
+
+        atlas, rects = LevelCache.pack_atlas(list(images))
+        scaled_atlas = pygame.transform.scale(atlas, (atlas.get_width() * scale[0], atlas.get_height() * scale[1]))
+        atlas_pixels = [pygame.image.tobytes(atlas, 'RGBA'), pygame.image.tobytes(scaled_atlas, 'RGBA')]
+        blobs.extend(zlib.compress(pixels, 1) for pixels in atlas_pixels)
+
+        metadata = {'key': LevelCache.get_key(level_path, data_path),
+                    'sources': LevelCache.get_sources(level_path),
+                    'level_data': level_data,
+                    'scale': list(scale),
+                    'layers': layers,
+                    'object_layers': object_layers,
+                    'atlas_size': list(atlas.get_size()),
+                    'rects': rects,
+                    'blobs': [len(blob) for blob in blobs]}
+        metadata_bytes = json.dumps(metadata).encode()
+
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(metadata_bytes)))
+            file.write(metadata_bytes)
+            for blob in blobs:
+                file.write(blob)
+        os.replace(temp_path, cache_path)
+
+        return metadata, blobs[:-2] + atlas_pixels
+
+    @staticmethod
+    def pack_atlas(surfaces):
+        # shelf packing, rows of images about as wide as a square atlas would be
+        area = sum(surf.get_width() * surf.get_height() for surf in surfaces)
+        width = max([int(area ** 0.5) + 1] + [surf.get_width() for surf in surfaces])
+        rects = []
+        x = y = row_height = 0
+        for surf in surfaces:
+            if x + surf.get_width() > width:
+                x, y, row_height = 0, y + row_height, 0
+            rects.append([x, y, surf.get_width(), surf.get_height()])
+            x += surf.get_width()
+            row_height = max(row_height, surf.get_height())
+
+        atlas = pygame.Surface((width, max(1, y + row_height)), pygame.SRCALPHA)
+        for surf, rect in zip(surfaces, rects):
+            atlas.blit(surf, rect[:2])
+        return atlas, rects
+
+    @staticmethod
+    def read(cache_path):
+        with open(cache_path, 'rb') as file:
+            magic, version, metadata_length = HEADER.unpack(file.read(HEADER.size))
+            if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                raise ValueError('unknown cache format')
+            metadata = json.loads(file.read(metadata_length))
+            blobs = [file.read(length) for length in metadata['blobs']]
+
+        blobs[-2:] = [zlib.decompress(blob) for blob in blobs[-2:]]
+        return metadata, blobs
+
+    @staticmethod
+    def build(cached, scale):
+        metadata, blobs = cached
+        atlas_size = metadata['atlas_size']
+        atlas = pygame.image.frombytes(blobs[-2], atlas_size, 'RGBA').convert_alpha()
+        images = [atlas.subsurface(rect) for rect in metadata['rects']]
+
+        # the pre-scaled atlas only helps if the level is built at the scale it was compiled for,
+        # the low resolution renderer draws tiles unscaled, so it would only take up memory there
+        if metadata['scale'] == list(scale) and not LOW_RES_SCALE:
+            scaled_size = (atlas_size[0] * scale[0], atlas_size[1] * scale[1])
+            scaled_atlas = pygame.image.frombytes(blobs[-1], scaled_size, 'RGBA').convert_alpha()
+            for image, (x, y, width, height) in zip(images, metadata['rects']):
+                scaled = scaled_atlas.subsurface((x * scale[0], y * scale[1], width * scale[0], height * scale[1]))
+                ScaledSurfaces.register(image, scale, scaled)
+
+        layers = {}
+        for layer, blob in zip(metadata['layers'], blobs):
+            grid = array('I')
+            grid.frombytes(blob)
+            layers[layer['name']] = CompiledTileLayer(layer['name'], layer['width'], layer['height'], grid, images)
+
+        for object_layer in metadata['object_layers']:
+            layers[object_layer['name']] = [CompiledObject(name, x, y, width, height, images[image - 1] if image else None, properties)
+                                            for name, x, y, width, height, image, properties in object_layer['objects']]
+
+        return CompiledMap(layers), metadata['level_data']
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from settings import LEVEL_POOL_SIZE, LOADER_FRAME_BUDGET
+from loading import LevelLoader
+
+
+class LevelManager:
+    # the current level and the ones visited recently, kept whole so going back restores their objects,
+    # plus the target of the door nearest to the player, loaded in the background before it is entered
+    def __init__(self, pool_size=LEVEL_POOL_SIZE, data_path='level_data.json'):
+        # level path -> Level, least recently used first
+        self.pool = OrderedDict()
+        self.pool_size = pool_size
+        # every level behind a door is built with the same level data as the first one
+        self.data_path = data_path
+        self.level = None
+        self.preloader = None
+        # kept outside the pool until it is entered, so what gets evicted only depends on the levels visited,
+        # not on when preloading happened to finish
+        self.preloaded = None
+
+    def set_level(self, level, previous_path=None):
+        self.pool[level.level_path] = level
+        self.pool.move_to_end(level.level_path)
+        self.level = level
+        level.activate(previous_path)
+        self.evict()
+
+    def evict(self):
+        while len(self.pool) > self.pool_size:
+            self.pool.popitem(last=False)
+
+    def is_loaded(self, target):
+        return target in self.pool or (self.preloaded is not None and self.preloaded.level_path == target)
+
+    def update(self, budget=LOADER_FRAME_BUDGET):
+        if self.preloader:
+            self.preloader.update(budget)
+            if self.preloader.done:
+                self.preloaded = self.preloader.level
+                self.preloader = None
+            return
+
+        target = self.level.get_nearest_door_target()
+        if target and not self.is_loaded(target):
+            self.preloader = LevelLoader(target, self.data_path)
+
+    def enter(self, target):
+        # instant when the level is pooled or preloaded, otherwise the rest of its loading happens now
+        level = self.pool.get(target)
+        if level is None and self.preloaded is not None and self.preloaded.level_path == target:
+            level = self.preloaded
+            self.preloaded = None
+        if level is None:
+            loader = self.preloader if self.preloader and self.preloader.level_path == target else LevelLoader(target, self.data_path)
+            loader.complete()
+            level = loader.level
+            self.preloader = None
+
+        self.set_level(level, self.level.level_path)
+        return level
@@ -0,0 +1,124 @@
+import time
+import pygame
+from types import GeneratorType
+from concurrent.futures import ThreadPoolExecutor
+from settings import *
+from support import AtlasTexture, SoundBank
+from level import Level
+from level_cache import LevelCache
+
+
+class AssetLoader:
+    # reads and decodes files on worker threads, results are finished on the main thread in submission order
+    def __init__(self, workers=LOADER_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='loader')
+        # (label, future or None for main thread only steps, finish)
+        self.jobs = []
+        self.finished = 0
+        # the remaining steps of a main thread job that was split up, None between jobs
+        self.steps = None
+
+    def submit(self, label, finish, load=None, *args):
+        future = self.executor.submit(load, *args) if load else None
+        self.jobs.append((label, future, finish))
+
+    @property
+    def done(self):
+        return self.finished == len(self.jobs)
+
+    @property
+    def progress(self):
+        return self.finished / len(self.jobs) if self.jobs else 1
+
+    @property
+    def status(self):
+        return self.jobs[self.finished][0] if not self.done else ''
+
+    def update(self, budget=LOADER_FRAME_BUDGET):
+        # finishes ready jobs until the frame budget is spent, so the loading screen keeps drawing
+        start = time.perf_counter()
+        while not self.done and time.perf_counter() - start < budget:
+            label, future, finish = self.jobs[self.finished]
+            if future is not None and not future.done():
+                break
+            self.finish_job()
+
+        if self.done:
+            self.executor.shutdown(wait=False)
+
+    def complete(self):
+        # finishes every job now, waiting for the ones still running
+        while not self.done:
+            self.finish_job()
+        self.executor.shutdown(wait=False)
+
+    def finish_job(self):
+        if self.steps is None:
+            label, future, finish = self.jobs[self.finished]
+            result = finish() if future is None else finish(future.result())
+            if not isinstance(result, GeneratorType):
+                self.finished += 1
+                return
+            # a finish that returns a generator runs one step per call, so the frame budget is checked in between
+            self.steps = result
+
+        try:
+            next(self.steps)
+        except StopIteration:
+            self.steps = None
+            self.finished += 1
+
+
+class LevelLoader(AssetLoader):
+    def __init__(self, level_path=LEVEL_PATH['first_level'], data_path='level_data.json'):
+        super().__init__()
+        self.level_path = level_path
+        self.data_path = data_path
+        self.level_assets = None
+        self.level = None
+
+        # sheets and sounds another level already loaded are shared
+        for texture_path in dict.fromkeys(TEXTURE_PATH.values()):
+            if AtlasTexture.has_texture(texture_path):
+                continue
+            self.submit(f'texture {texture_path}', lambda surf, path=texture_path: AtlasTexture.add_texture(path, surf.convert_alpha()),
+                        pygame.image.load, texture_path)
+
+        # music is streamed while it plays, only sound effects are decoded up front
+        for sound_path in dict.fromkeys(SOUND_PATH.values()):
+            if sound_path in SoundBank.sounds:
+                continue
+            self.submit(f'sound {sound_path}', lambda sound, path=sound_path: SoundBank.add_sound(path, sound),
+                        pygame.mixer.Sound, sound_path)
+
+        self.submit('map', self.finish_map, LevelCache.fetch, level_path, data_path)
+        self.submit('level', self.build_level)
+
+    def finish_map(self, cached):
+        self.level_assets = LevelCache.finish(cached, self.level_path, self.data_path)
+
+    def build_level(self):
+        self.level = Level(self.level_path, self.data_path, self.level_assets, deferred=True)
+        return self.level.build_steps(self.level_path, self.data_path)
+
+
+class LoadingScreen:
+    def __init__(self):
+        self.display_surface = pygame.display.get_surface()
+        self.font = pygame.font.Font(GAME_FONT, 32)
+        self.bar_rect = pygame.Rect(0, 0, SCREEN_WIDTH // 2, 24)
+        self.bar_rect.center = (SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
+
+    def draw(self, progress, status):
+        self.display_surface.fill('black')
+
+        title = self.font.render(f'Loading {progress * 100:3.0f}%', False, 'White')
+        self.display_surface.blit(title, title.get_rect(midbottom=(self.bar_rect.centerx, self.bar_rect.top - 10)))
+
+        pygame.draw.rect(self.display_surface, 'White', self.bar_rect, 2)
+        fill_rect = self.bar_rect.inflate(-8, -8)
+        fill_rect.width = int(fill_rect.width * progress)
+        pygame.draw.rect(self.display_surface, 'White', fill_rect)
+
+        label = self.font.render(status, False, 'Gray')
+        self.display_surface.blit(label, label.get_rect(midtop=(self.bar_rect.centerx, self.bar_rect.bottom + 10)))
@@ -1,30 +1,129 @@
 import pygame
 import sys
-from settings import SCREEN_WIDTH, SCREEN_HEIGHT
-from level import Level
+import random
+import argparse
+from settings import SCREEN_WIDTH, SCREEN_HEIGHT, FPS_LIMIT, VSYNC, SIM_RATE, MAX_SIM_STEPS, LEVEL_PATH
+from loading import LevelLoader, LoadingScreen
+from level_manager import LevelManager
+from profiler import profiler
+from recording import InputRecording, InputRecorder, MAX_SEED
+from support import channel_pool, rng
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, record_path=None, seed=None):
         pygame.init()
         pygame.mixer.init()
-        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        # pygame only honours vsync on scaled or opengl displays
+        flags = pygame.SCALED if VSYNC else 0
+        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), flags, vsync=int(VSYNC))
         pygame.display.set_caption('RussianVillage')
         self.clock = pygame.time.Clock()
-        self.level = Level()
+
+        # the session's seed is fixed before the level rolls anything, a recording stores it with the input
+        self.seed = random.getrandbits(32) if seed is None else seed
+        rng.seed(self.seed)
+        self.record_path = record_path
+        self.recorder = InputRecorder(InputRecording(LEVEL_PATH['first_level'], self.seed)) if record_path else None
+
+        # the level is built by the loader while the loading screen is shown
+        self.level = None
+        self.loader = LevelLoader()
+        self.loading_screen = LoadingScreen()
+        self.levels = LevelManager()
+
+        # fixed timestep
+        self.sim_step = 1 / SIM_RATE
+        self.accumulator = 0
 
     def run(self):
+        # the recording is written however the session ends, a crash included
+        try:
+            self.loop()
+        finally:
+            self.save_recording()
+
+    def loop(self):
         while True:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
+                    profiler.close()
                     pygame.quit()
                     sys.exit()
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_F3 and self.level:
+                    self.level.toggle_profiler()
+                if event.type in channel_pool.end_events:
+                    channel_pool.handle_event(event)
+
+            if not self.level:
+                self.load()
+                continue
+
+            self.accumulator += self.clock.tick(FPS_LIMIT) / 1000
+            profiler.begin_frame()
+
+            steps = 0
+            while self.accumulator >= self.sim_step and steps < MAX_SIM_STEPS:
+                if self.recorder:
+                    self.recorder.sample()
+                self.level.update(self.sim_step)
+                self.accumulator -= self.sim_step
+                steps += 1
+                # a door switches levels right after the step it fired in, the next step would clear it
+                if self.level.entered_door:
+                    break
+
+            # drop the backlog after a long stall instead of spiralling
+            if steps == MAX_SIM_STEPS:
+                self.accumulator %= self.sim_step
 
-            dt = self.clock.tick(60) / 1000
-            self.level.run(dt)
-            pygame.display.update()
+            if self.level.entered_door:
+                self.level = self.levels.enter(self.level.entered_door[1])
+                self.use_recorder()
+
+            self.level.draw(self.accumulator / self.sim_step)
+            profiler.end_frame()
+            self.level.draw_overlay()
+            self.level.present()
+            # the level behind the nearest door loads a little every frame
+            self.levels.update()
+
+    def load(self):
+        self.loader.update()
+        if self.loader.done:
+            self.level = self.loader.level
+            self.levels.set_level(self.level)
+            self.use_recorder()
+            # loading time is not simulated
+            self.clock.tick()
+            return
+
+        self.loading_screen.draw(self.loader.progress, self.loader.status)
+        pygame.display.update()
+        self.clock.tick(FPS_LIMIT)
+
+    def use_recorder(self):
+        if self.recorder:
+            self.level.player.key_source = self.recorder.get_pressed
+
+    def save_recording(self):
+        if self.recorder and self.level:
+            self.recorder.recording.final_state = tuple(self.level.player.pos)
+            self.recorder.recording.save(self.record_path)
+
+
+def parse_seed(value):
+    seed = int(value)
+    if not 0 <= seed <= MAX_SEED:
+        raise argparse.ArgumentTypeError(f'seed must be between 0 and {MAX_SEED}')
+    return seed
 
 
 if __name__ == '__main__':
-    game = Game()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', help='write the session input to this file, replay it with replay.py')
+    parser.add_argument('--seed', type=parse_seed, help='seed for gameplay randomness, random when not given')
+    args = parser.parse_args()
+
+    game = Game(args.record, args.seed)
     game.run()
@@ -1,7 +1,7 @@
 import pygame
 import copy
 from settings import *
-from support import AtlasTexture, SoundManager, Timer
+from support import AtlasTexture, SoundManager
 
 
 class Player(pygame.sprite.Sprite):
@@ -34,11 +34,13 @@ class Player(pygame.sprite.Sprite):
         self.direction = pygame.math.Vector2()
 
         # logic attributes
+        self.key_source = pygame.key.get_pressed
         self.sleep = False
         self.can_sound = True
 
         # collision
         self.hitbox = self.rect.copy().inflate(-60, -40)
+        self.visible_sprites = group
         self.collision_sprites = collision_sprites
         self.physics_sprites = physics_sprites
         # self.pickups_sprites = pickups_sprites
@@ -99,7 +101,7 @@ class Player(pygame.sprite.Sprite):
         self.sounds = {
             'step': SOUND_PATH['player_step']
         }
-        self.sound_manager = SoundManager(self.sounds)
+        self.sound_manager = SoundManager(self.sounds, SOUND_PRIORITY['player'])
 
     # def set_accessory(self, name):
     #     self.active_accessories[name.split('_')[0]] = self.accessories_animations[name]
@@ -140,7 +142,7 @@ class Player(pygame.sprite.Sprite):
             return
 
         # direction
-        keys = pygame.key.get_pressed()
+        keys = self.key_source()
         if keys[pygame.K_w]:
             self.direction.y = -1
         elif keys[pygame.K_s]:
@@ -174,14 +176,22 @@ class Player(pygame.sprite.Sprite):
         self.hitbox.centery = round(self.pos.y)
         self.rect.centery = self.hitbox.centery
         self.collision('vertical', dt)
+        self.visible_sprites.move_sprite(self)
+
+    def place(self, center):
+        # moves the player without colliding, e.g. to the door it came through
+        self.pos.update(center)
+        self.hitbox.center = (round(self.pos.x), round(self.pos.y))
+        self.rect.center = self.hitbox.center
+        self.visible_sprites.move_sprite(self)
 
     def collision(self, direction, dt):
-        for sprite in self.collision_sprites.sprites():
+        for sprite in self.collision_sprites.query(self.hitbox):
             if hasattr(sprite, 'hitbox'):
                 if sprite.hitbox.colliderect(self.hitbox):
                     self.collision_handler(sprite, direction)
 
-        for sprite in self.physics_sprites.sprites():
+        for sprite in self.physics_sprites.query(self.hitbox):
             if hasattr(sprite, 'hitbox'):
                 if sprite.hitbox.colliderect(self.hitbox):
                     self.collision_handler(sprite, direction)
@@ -218,4 +228,3 @@ class Player(pygame.sprite.Sprite):
         # self.get_target_pos()
         self.move(dt)
         self.animate(dt)
-        self.sound_manager.update()
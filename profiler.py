@@ -0,0 +1,120 @@
+import csv
+import time
+import pygame
+from settings import GAME_FONT, PROFILER_CSV_PATH
+
+
+class ProfileScope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timings = self.profiler.timings
+        timings[self.name] = timings.get(self.name, 0) + time.perf_counter() - self.start_time
+
+
+class Profiler:
+    def __init__(self, csv_path=None, smoothing=0.05):
+        self.smoothing = smoothing
+        self.frame = 0
+        self.frame_start = 0
+
+        # values of the frame in progress
+        self.timings = {}
+        self.counters = {}
+
+        # smoothed timings and counters of finished frames
+        self.averages = {}
+        self.last_counters = {}
+
+        self.csv_file = None
+        self.csv_writer = None
+        if csv_path:
+            self.open_csv(csv_path)
+
+    def scope(self, name):
+        return ProfileScope(self, name)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def begin_frame(self):
+        self.timings = {}
+        self.counters = {}
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        self.timings['frame'] = time.perf_counter() - self.frame_start
+
+        for name, value in self.timings.items():
+            average = self.averages.get(name, value)
+            self.averages[name] = average + (value - average) * self.smoothing
+        self.last_counters = self.counters
+
+        if self.csv_file:
+            self.write_csv_row()
+        self.frame += 1
+
+    def open_csv(self, csv_path):
+        # one row per sample, so scopes and counters can come and go between frames
+        self.csv_file = open(csv_path, 'w', newline='')
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(['frame', 'name', 'value'])
+
+    def write_csv_row(self):
+        for name, value in self.timings.items():
+            self.csv_writer.writerow([self.frame, f'{name}_ms', f'{value * 1000:.4f}'])
+        for name, value in self.counters.items():
+            self.csv_writer.writerow([self.frame, name, value])
+
+    def close(self):
+        if self.csv_file:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
+
+
+class ProfilerOverlay:
+    def __init__(self, profiler, refresh_delay=250):
+        self.profiler = profiler
+        self.display_surface = pygame.display.get_surface()
+        self.font = pygame.font.Font(GAME_FONT, 32)
+        self.refresh_delay = refresh_delay
+        self.last_refresh = -refresh_delay
+        self.lines = []
+
+    def render_lines(self):
+        averages = self.profiler.averages
+        frame_time = averages.get('frame', 0)
+        fps = 1 / frame_time if frame_time else 0
+        texts = [f'frame {frame_time * 1000:6.2f} ms  {fps:5.0f} fps']
+        texts.extend(f'{name:<8}{value * 1000:6.2f} ms' for name, value in averages.items() if name != 'frame')
+        texts.extend(f'{name} {value}' for name, value in self.profiler.last_counters.items())
+        self.lines = [self.font.render(text, False, 'White') for text in texts]
+
+    def draw(self):
+        current_time = pygame.time.get_ticks()
+        if current_time - self.last_refresh >= self.refresh_delay:
+            self.render_lines()
+            self.last_refresh = current_time
+
+        if not self.lines:
+            return None
+
+        line_height = self.lines[0].get_height()
+        width = max(line.get_width() for line in self.lines) + 20
+        background = pygame.Surface((width, line_height * len(self.lines) + 20))
+        background.set_alpha(160)
+        overlay_rect = self.display_surface.blit(background, (10, 10))
+        for index, line in enumerate(self.lines):
+            self.display_surface.blit(line, (20, 20 + index * line_height))
+        return overlay_rect
+
+
+profiler = Profiler(PROFILER_CSV_PATH)
@@ -0,0 +1,111 @@
+import os
+import struct
+import pygame
+from collections import defaultdict
+from settings import SIM_RATE
+
+REPLAY_MAGIC = b'RPIN'
+REPLAY_VERSION = 1
+# magic, version, seed, simulation rate, ticks, level path length
+HEADER = struct.Struct('<4sHIHII')
+# player position after the last tick, replays compare against it
+FINAL_STATE = struct.Struct('<dd')
+# key bitmask and how many ticks in a row it was held
+RUN = struct.Struct('<BI')
+# seeds are stored as uint32
+MAX_SEED = 2 ** 32 - 1
+
+# the keys Player.input reads, in bitmask order
+KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d)
+
+
+class InputRecording:
+    # one session's input as runs of key bitmasks, one bitmask per simulation tick
+    def __init__(self, level_path, seed, sim_rate=SIM_RATE):
+        # checked up front, a seed the header cannot hold would only fail when the session is saved
+        if not 0 <= seed <= MAX_SEED:
+            raise ValueError(f'seed must be between 0 and {MAX_SEED}, got {seed}')
+        self.level_path = level_path
+        self.seed = seed
+        self.sim_rate = sim_rate
+        self.runs = []
+        self.ticks = 0
+        self.final_state = (0.0, 0.0)
+
+    def append(self, mask):
+        if self.runs and self.runs[-1][0] == mask:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([mask, 1])
+        self.ticks += 1
+
+    def save(self, path):
+        level_path = self.level_path.encode()
+        # written next to the target first, so a failed save leaves an older recording in place
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, self.sim_rate, self.ticks, len(level_path)))
+            file.write(level_path)
+            file.write(FINAL_STATE.pack(*self.final_state))
+            for mask, count in self.runs:
+                file.write(RUN.pack(mask, count))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            magic, version, seed, sim_rate, ticks, path_length = HEADER.unpack(file.read(HEADER.size))
+            if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+                raise ValueError(f'{path} is not a replay this version can read')
+            recording = InputRecording(file.read(path_length).decode(), seed, sim_rate)
+            recording.final_state = FINAL_STATE.unpack(file.read(FINAL_STATE.size))
+            data = file.read()
+
+        recording.runs = [list(run) for run in RUN.iter_unpack(data)]
+        recording.ticks = ticks
+        return recording
+
+
+class InputRecorder:
+    # key source for Player: the keyboard as sampled at the start of each tick, every sample is recorded
+    def __init__(self, recording, key_source=pygame.key.get_pressed):
+        self.recording = recording
+        self.key_source = key_source
+        self.keys = defaultdict(bool)
+
+    def sample(self):
+        self.keys = self.key_source()
+        self.recording.append(sum(1 << bit for bit, key in enumerate(KEYS) if self.keys[key]))
+
+    def get_pressed(self):
+        return self.keys
+
+
+class InputReplay:
+    # key source for Player that plays a recording back tick by tick, releasing every key once it has run out
+    def __init__(self, recording):
+        self.recording = recording
+        self.run = 0
+        self.tick_in_run = 0
+        self.keys = defaultdict(bool)
+
+    @property
+    def done(self):
+        return self.run >= len(self.recording.runs)
+
+    def sample(self):
+        self.keys = defaultdict(bool)
+        if self.done:
+            return
+
+        mask, count = self.recording.runs[self.run]
+        for bit, key in enumerate(KEYS):
+            self.keys[key] = bool(mask & (1 << bit))
+
+        self.tick_in_run += 1
+        if self.tick_in_run == count:
+            self.run += 1
+            self.tick_in_run = 0
+
+    def get_pressed(self):
+        return self.keys
@@ -0,0 +1,123 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+# headless drivers have to be selected before pygame creates a display or mixer
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+from settings import SCREEN_WIDTH, SCREEN_HEIGHT
+from profiler import profiler
+from support import music_player, rng
+from benchmark import Benchmark, PERCENTILES
+from recording import InputRecording, InputReplay
+
+REPLAY_PHASES = ['update', 'draw', 'frame']
+
+
+class Replay:
+    # runs a recording headless, one simulation tick and one draw per frame, and times every frame
+    def __init__(self, recording, data_path='level_data.json'):
+        self.recording = recording
+        self.dt = 1 / recording.sim_rate
+
+        pygame.init()
+        pygame.mixer.init()
+        pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+
+        # imported here so sprites can convert surfaces against the dummy display
+        from loading import LevelLoader
+        from level_manager import LevelManager
+
+        # the seed has to be in place before the level rolls its chests' loot
+        rng.seed(recording.seed)
+        self.input = InputReplay(recording)
+        loader = LevelLoader(recording.level_path, data_path)
+        loader.complete()
+        self.levels = LevelManager(data_path=data_path)
+        self.levels.set_level(loader.level)
+        self.level = loader.level
+        self.level.player.key_source = self.input.get_pressed
+        self.samples = {phase: [] for phase in REPLAY_PHASES}
+
+    def run(self):
+        for _ in range(self.recording.ticks):
+            pygame.event.pump()
+            profiler.begin_frame()
+
+            start = time.perf_counter()
+            self.input.sample()
+            self.level.update(self.dt)
+            # the same point Game.run switches levels at: right after the step a door fired in. Levels the game
+            # preloaded are not, they roll from their own generator and only join the pool once entered
+            if self.level.entered_door:
+                self.level = self.levels.enter(self.level.entered_door[1])
+                self.level.player.key_source = self.input.get_pressed
+            after_update = time.perf_counter()
+            self.level.draw()
+            self.level.present()
+            end = time.perf_counter()
+            profiler.end_frame()
+
+            self.samples['update'].append(after_update - start)
+            self.samples['draw'].append(end - after_update)
+            self.samples['frame'].append(end - start)
+
+    def get_report(self):
+        phases = {}
+        for phase, values in self.samples.items():
+            stats = {f'p{percent}': Benchmark.percentile(values, percent) * 1000 for percent in PERCENTILES}
+            stats['mean'] = sum(values) / len(values) * 1000 if values else 0
+            stats['max'] = max(values, default=0) * 1000
+            phases[phase] = stats
+
+        final_state = tuple(self.level.player.pos)
+        return {'level': self.recording.level_path,
+                'seed': self.recording.seed,
+                'ticks': self.recording.ticks,
+                'final_state': list(final_state),
+                'recorded_final_state': list(self.recording.final_state),
+                # a replay that ends elsewhere did not reproduce the session, so its timings are not comparable
+                'in_sync': final_state == self.recording.final_state,
+                'phases_ms': phases,
+                'frame_times_ms': [value * 1000 for value in self.samples['frame']],
+                'python': platform.python_version(),
+                'pygame': pygame.version.ver,
+                'platform': platform.platform()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless replay of a recorded session with per-frame timings')
+    parser.add_argument('recording', help='file written by main.py --record')
+    parser.add_argument('--data', default='level_data.json', help='level data the session was recorded with')
+    parser.add_argument('--output', default='replay_results.json')
+    args = parser.parse_args(argv)
+
+    recording = InputRecording.load(os.path.abspath(args.recording))
+    output = os.path.abspath(args.output)
+    # level, data and asset paths are relative to the project root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    replay = Replay(recording, args.data)
+    replay.run()
+    report = replay.get_report()
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    for phase, stats in report['phases_ms'].items():
+        print(f"{phase:<8} p50 {stats['p50']:7.3f} ms  p95 {stats['p95']:7.3f} ms  p99 {stats['p99']:7.3f} ms")
+    print(f"{report['ticks']} ticks, {'in sync' if report['in_sync'] else 'OUT OF SYNC'}, results written to {output}")
+
+    music_player.stop()
+    pygame.quit()
+    # a desynced replay fails the run, so CI notices
+    return 0 if report['in_sync'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,20 @@
 # game settings
 SCREEN_WIDTH, SCREEN_HEIGHT = 1920, 1080
+FPS_LIMIT = 60  # 0 renders uncapped
+VSYNC = False
+DIRTY_RECTS = False  # only redraw and present changed screen areas while the camera is still
+LOW_RES_SCALE = 0  # compose the world at pixel art resolution and upscale it by this factor, 0 draws at full size
+SIM_RATE = 60  # fixed simulation steps per second
+MAX_SIM_STEPS = 5  # catch-up steps per frame before dropping time
 TILE_SIZE = 16
+COLLISION_CELL_SIZE = TILE_SIZE * 6  # one scaled tile
+CHUNK_SIZE = 8  # tiles per side of a baked tile chunk
+LEVEL_STREAMING = False  # only build sprites for chunks around the player
+STREAM_RADIUS = 2  # chunks kept loaded around the player
+STREAM_PREFETCH = 2  # chunks ahead of the player's direction of travel to preload
+STREAM_PREFETCH_LOADS = 2  # prefetched chunks built per update
+ENTITY_STORE = False  # keep physics props in numpy arrays, pushed props slide until friction stops them
+ENTITY_FRICTION = 4  # share of a sliding prop's speed lost per second
 LAYERS = {
     'ground': 8,
     'walls': 9,
@@ -53,8 +67,44 @@ MUSIC_PATH = {
     'first_level': 'sounds/music/first_level.wav'
 }
 
+TEXTURE_CACHE_SIZE = 64 * 1024 * 1024  # bytes
+
+# mixer channels shared by all sounds, and how many copies of one sound may play at once
+SOUND_CHANNELS = 16
+SOUND_VOICE_LIMIT = 4
+
+# sounds with a higher priority take channels from lower ones when the pool is full
+SOUND_PRIORITY = {
+    'player': 1
+}
+
+# music is streamed from disk, fades are in milliseconds, ducking in seconds
+MUSIC_VOLUME = 0.2
+MUSIC_FADE_TIME = 1000
+MUSIC_DUCK_LEVEL = 0.3
+MUSIC_DUCK_TIME = 0.25
+
+LEVEL_PATH = {
+    'first_level': 'tiled/level1_1.tmx'
+}
+
+# levels kept in memory with their object states, the current one included
+LEVEL_POOL_SIZE = 3
+# doors trigger this many world pixels around their rect
+DOOR_REACH = 12
+
+# compiled levels are kept here and rebuilt when their sources change, None always parses the tmx
+LEVEL_CACHE_DIR = 'cache'
+
+# asset loading threads, and the main thread time per loading screen frame spent finishing their results
+LOADER_WORKERS = 4
+LOADER_FRAME_BUDGET = 0.008  # seconds
+
 GAME_FONT = 'font/monogram-extended.ttf'
 
+# stream per-frame profiler samples to this csv file, None to disable
+PROFILER_CSV_PATH = None
+
 INVENTORY_ITEMS = {
     'empty': 0
 }
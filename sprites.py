@@ -1,7 +1,5 @@
 import pygame
-import copy
-import random
-from support import AtlasTexture
+from support import AnimationLibrary, ScaledSurfaces, normalize_surface, animation_clock
 from settings import *
 
 
@@ -12,13 +10,7 @@ class Generic(pygame.sprite.Sprite):
         self.id = id
         self.name = name
 
-        if image_scale:
-            image = pygame.transform.scale(surf,
-                                           (surf.get_width() * image_scale[0], surf.get_height() * image_scale[1]))
-        else:
-            image = pygame.transform.scale(surf, (surf.get_width() * scale[0], surf.get_height() * scale[1]))
-
-        self.image = image
+        self.image = ScaledSurfaces.get(surf, scale, image_scale)
         self.size = (self.image.get_height(), self.image.get_width())
         scaled_pos = (pos[0] * scale[0], pos[1] * scale[1])
         self.rect = self.image.get_rect(topleft=scaled_pos)
@@ -26,23 +18,158 @@ class Generic(pygame.sprite.Sprite):
         self.hitbox = self.rect.copy().inflate(OBJECTS_SIZE[self.name][1])
 
 
-class GenericPhysics(pygame.sprite.Sprite):
+class TileChunk(pygame.sprite.Sprite):
+    # one CHUNK_SIZE square of a TileLayer baked into a single image
+    def __init__(self, chunk_pos, tile_layer, groups):
+        super().__init__(groups)
+        self.tile_layer = tile_layer
+        self.name = tile_layer.name
+        self.z = tile_layer.z
+        self.cells = TileChunk.get_cells(chunk_pos)
+        self.origin = (self.cells[0] * tile_layer.tile_size[0], self.cells[1] * tile_layer.tile_size[1])
+        self.rect = pygame.Rect(self.origin, (CHUNK_SIZE * tile_layer.tile_size[0], CHUNK_SIZE * tile_layer.tile_size[1]))
+
+        self.baked_image = None
+        self.dirty = True
+        # the chunk at pixel art resolution, for the low resolution renderer
+        self.low_res_image = None
+        self.low_res_dirty = True
+
+    @staticmethod
+    def get_cells(chunk_pos):
+        # inclusive cell range covered by a chunk
+        left, top = chunk_pos[0] * CHUNK_SIZE, chunk_pos[1] * CHUNK_SIZE
+        return left, top, left + CHUNK_SIZE - 1, top + CHUNK_SIZE - 1
+
+    @property
+    def image(self):
+        # chunks are rebuilt lazily, the first time they are drawn after a tile change
+        if self.dirty:
+            self.bake()
+        return self.baked_image
+
+    def get_low_res_image(self):
+        if self.low_res_dirty:
+            self.bake_low_res()
+        return self.low_res_image
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.low_res_dirty = True
+
+    def prepare(self):
+        # bakes the image the current render mode draws, the other one is only built if it is ever asked for
+        if LOW_RES_SCALE:
+            self.bake_low_res()
+        else:
+            self.bake()
+
+    @staticmethod
+    def compose(tiles, bounds):
+        for _, tile_rect in tiles:
+            bounds.union_ip(tile_rect)
+
+        image = pygame.Surface(bounds.size, pygame.SRCALPHA).convert_alpha()
+        image.blits([(surf, tile_rect.move(-bounds.x, -bounds.y)) for surf, tile_rect in tiles], doreturn=False)
+        # chunks of a fully covered floor are stored without alpha
+        return normalize_surface(image)
+
+    def bake(self):
+        tile_width, tile_height = self.tile_layer.tile_size
+        tiles = [(surf, surf.get_rect(topleft=(x * tile_width, y * tile_height)))
+                 for x, y, surf in self.tile_layer.get_tiles(*self.cells)]
+
+        bounds = pygame.Rect(self.origin, (CHUNK_SIZE * tile_width, CHUNK_SIZE * tile_height))
+        self.baked_image = TileChunk.compose(tiles, bounds)
+        self.rect = bounds
+        self.dirty = False
+
+    def bake_low_res(self):
+        # composed from the unscaled tiles and brought to 1/LOW_RES_SCALE of the world, the rect stays in world coordinates
+        scale_x, scale_y = self.tile_layer.scale
+        tiles = [(surf, surf.get_rect(topleft=(x * TILE_SIZE, y * TILE_SIZE)))
+                 for x, y, surf in self.tile_layer.get_tiles(*self.cells, scaled=False)]
+
+        bounds = pygame.Rect(self.cells[0] * TILE_SIZE, self.cells[1] * TILE_SIZE, CHUNK_SIZE * TILE_SIZE, CHUNK_SIZE * TILE_SIZE)
+        self.low_res_image = TileChunk.compose(tiles, bounds)
+        if (scale_x, scale_y) != (LOW_RES_SCALE, LOW_RES_SCALE):
+            size = (round(bounds.width * scale_x / LOW_RES_SCALE), round(bounds.height * scale_y / LOW_RES_SCALE))
+            self.low_res_image = pygame.transform.scale(self.low_res_image, size)
+        self.rect = pygame.Rect(bounds.x * scale_x, bounds.y * scale_y, bounds.width * scale_x, bounds.height * scale_y)
+        self.low_res_dirty = False
+
+
+class PushableBody:
+    # pushing between physics props, mixed into GenericPhysics and GenericPhysicsAnimaton, which provide the body
+    # (pos, rect, hitbox, direction) and its collision handling
+    def shift(self, direction, amount, pusher_direction):
+        # another body pushed into this one: move along that axis and pass the push on
+        if self.resolving:
+            return
+        self.resolving = True
+        self.direction = pygame.math.Vector2(pusher_direction)
+
+        if direction == 'horizontal':
+            self.pos.x += amount
+            self.hitbox.centerx = round(self.pos.x + self.hitbox_offset.x)
+            self.rect.centerx = self.hitbox.centerx
+
+        if direction == 'vertical':
+            self.pos.y += amount
+            self.hitbox.centery = round(self.pos.y + self.hitbox_offset.y)
+            self.rect.centery = self.hitbox.centery
+
+        self.collision(direction)
+        self.visible_sprites.move_sprite(self)
+        self.physics_sprites.move_sprite(self)
+        self.resolving = False
+
+    def resolve_contact(self, sprite, direction):
+        # placeable objects may rest on tables
+        if 'table' in sprite.name and self.name in CAN_BE_PLACED_ON \
+                or 'table' in self.name and sprite.name in CAN_BE_PLACED_ON:
+            return
+
+        # bodies further up the push chain stop against this one once it has moved
+        if getattr(sprite, 'resolving', False):
+            return
+
+        # push the other body out of the way first, then stop against wherever it ended up
+        overlap = self.get_overlap(sprite, direction)
+        if overlap and hasattr(sprite, 'shift'):
+            sprite.shift(direction, overlap, self.direction)
+
+        if sprite.hitbox.colliderect(self.hitbox):
+            self.collision_handler(sprite, direction)
+
+    def get_overlap(self, sprite, direction):
+        if direction == 'horizontal':
+            if self.direction.x > 0:  # moving right
+                return self.hitbox.right - sprite.hitbox.left
+            if self.direction.x < 0:  # moving left
+                return self.hitbox.left - sprite.hitbox.right
+
+        if direction == 'vertical':
+            if self.direction.y > 0:  # moving down
+                return self.hitbox.bottom - sprite.hitbox.top
+            if self.direction.y < 0:  # moving up
+                return self.hitbox.top - sprite.hitbox.bottom
+
+        return 0
+
+
+class GenericPhysics(PushableBody, pygame.sprite.Sprite):
     def __init__(self, id, pos, surf, groups, z=LAYERS['main'], scale=(1, 1), name='Generic', hitbox=True, image_scale=None):
         super().__init__([groups[0], groups[2]])
         self.id = id
         self.name = name
 
         # sprite groups
+        self.visible_sprites = groups[0]
         self.collision_sprites = groups[1]
         self.physics_sprites = groups[2]
 
-        if image_scale:
-            image = pygame.transform.scale(surf,
-                                           (surf.get_width() * image_scale[0], surf.get_height() * image_scale[1]))
-        else:
-            image = pygame.transform.scale(surf, (surf.get_width() * scale[0], surf.get_height() * scale[1]))
-
-        self.image = image
+        self.image = ScaledSurfaces.get(surf, scale, image_scale)
         self.size = OBJECTS_SIZE[self.name][0] if self.name in OBJECTS_SIZE else (self.image.get_height(), self.image.get_width())
         scaled_pos = (pos[0] * scale[0], pos[1] * scale[1])
         self.rect = self.image.get_rect(topleft=scaled_pos)
@@ -56,11 +183,13 @@ class GenericPhysics(pygame.sprite.Sprite):
         # movement
         self.direction = pygame.math.Vector2(0, 0)
         self.weight = 100
+        self.resolving = False
 
     def move(self, player_direction, dt):
         # normalizing a vector
         if player_direction.magnitude() > 0:
             self.direction = player_direction.normalize()
+        self.resolving = True
 
         # horizontal movement
         self.pos.x += self.direction.x * self.weight * dt
@@ -73,22 +202,20 @@ class GenericPhysics(pygame.sprite.Sprite):
         self.hitbox.centery = round(self.pos.y + self.hitbox_offset.y)
         self.rect.centery = self.hitbox.centery
         self.collision('vertical')
+        self.visible_sprites.move_sprite(self)
+        self.physics_sprites.move_sprite(self)
+        self.resolving = False
 
     def collision(self, direction):
-        for sprite in self.collision_sprites.sprites():
+        for sprite in self.collision_sprites.query(self.hitbox):
             if hasattr(sprite, 'hitbox'):
                 if sprite.hitbox.colliderect(self.hitbox):
                     self.collision_handler(sprite, direction)
 
-        for sprite in self.physics_sprites.sprites():
-            if hasattr(sprite, 'hitbox'):
-                if sprite.hitbox.colliderect(self.hitbox) and sprite.id != self.id:
-
-                    if 'table' in sprite.name and self.name in CAN_BE_PLACED_ON \
-                            or 'table' in self.name and sprite.name in CAN_BE_PLACED_ON:
-                        return
-
-                    self.collision_handler(sprite, direction)
+        # broadphase candidates, each pair is resolved on its own
+        for sprite in self.physics_sprites.query(self.hitbox):
+            if sprite is not self and sprite.hitbox.colliderect(self.hitbox):
+                self.resolve_contact(sprite, direction)
 
     def collision_handler(self, sprite, direction):
         if direction == 'horizontal':
@@ -121,52 +248,40 @@ class GenericAnimation(pygame.sprite.Sprite):
         self.z = z
         self.size = OBJECTS_SIZE[self.name][0]
         self.state = 'idle'
-        self.animation_frames = None
         self.animations = None
         self.animation_speed = 6
-        self.animation_frame = 0
+        # clock time the current animation started at
+        self.animation_start = 0.0
+        self.animation_loop = True
 
         self.import_assets()
 
-        self.image = self.animations[self.state][self.animation_frame]
         scaled_pos = (pos[0] * scale[0], pos[1] * scale[1])
         self.pos = pygame.math.Vector2(scaled_pos[0], scaled_pos[1])
-        self.rect = self.image.get_rect(topleft=scaled_pos)
+        self.rect = self.animations[self.state][0].get_rect(topleft=scaled_pos)
         self.hitbox = self.rect.copy().inflate(OBJECTS_SIZE[self.name][1])
         if self.name in HITBOX_OFFSETS:
             self.hitbox.move_ip(HITBOX_OFFSETS[name])
 
     def import_assets(self):
+        # frame sets are shared by every instance with the same name, size and scale
+        self.animations = AnimationLibrary.get_animations(self.name, self.size, self.scale)
 
-        self.animation_frames = copy.deepcopy(ANIMATION_FRAMES[self.name])
-        self.animations = copy.deepcopy(DEFAULT_ANIMATIONS[self.name])
-
-        for state, animation_frames_list in self.animation_frames.items():
-            for frame in animation_frames_list:
-                image = AtlasTexture.get_image(texture_path=TEXTURE_PATH[self.name],
-                                               frame=frame,
-                                               size=self.size,
-                                               scale=self.scale)
-                self.animations[state].append(image)
-
-    def animate(self, dt):
-        self.animation_frame += self.animation_speed * dt
-        if self.animation_frame >= len(self.animations[self.state]):
-            self.animation_frame = 0
+    @property
+    def image(self):
+        # looked up when the sprite is drawn, so off screen animations cost nothing and come back on the right frame
+        return animation_clock.get_frame(self.animations[self.state], self.animation_speed, self.animation_start,
+                                         self.animation_loop)
 
-        self.image = self.animations[self.state][int(self.animation_frame)]
 
-    def update(self, dt):
-        self.animate(dt)
-
-
-class GenericPhysicsAnimaton(pygame.sprite.Sprite):
+class GenericPhysicsAnimaton(PushableBody, pygame.sprite.Sprite):
     def __init__(self, id, pos, surf, groups, z=LAYERS['main'], scale=(1, 1), name='Generic', hitbox=True, image_scale=None):
         super().__init__([groups[0], groups[2]])
         self.id = id
         self.name = name
 
         # sprite groups
+        self.visible_sprites = groups[0]
         self.collision_sprites = groups[1]
         self.physics_sprites = groups[2]
 
@@ -174,17 +289,17 @@ class GenericPhysicsAnimaton(pygame.sprite.Sprite):
         self.z = z
         self.size = OBJECTS_SIZE[self.name][0]
         self.state = 'idle'
-        self.animation_frames = None
         self.animations = None
         self.animation_speed = 6
-        self.animation_frame = 0
+        # clock time the current animation started at
+        self.animation_start = 0.0
+        self.animation_loop = True
 
         self.import_assets()
 
-        self.image = self.animations[self.state][self.animation_frame]
         scaled_pos = (pos[0] * scale[0], pos[1] * scale[1])
         self.pos = pygame.math.Vector2(scaled_pos[0], scaled_pos[1])
-        self.rect = self.image.get_rect(topleft=scaled_pos)
+        self.rect = self.animations[self.state][0].get_rect(topleft=scaled_pos)
         self.hitbox = self.rect.copy().inflate(OBJECTS_SIZE[self.name][1])
         if self.name in HITBOX_OFFSETS:
             self.hitbox.move_ip(HITBOX_OFFSETS[name])
@@ -194,23 +309,22 @@ class GenericPhysicsAnimaton(pygame.sprite.Sprite):
         # movement
         self.direction = pygame.math.Vector2(0, 0)
         self.weight = 100
+        self.resolving = False
 
     def import_assets(self):
-        self.animation_frames = copy.deepcopy(ANIMATION_FRAMES[self.name])
-        self.animations = copy.deepcopy(DEFAULT_ANIMATIONS[self.name])
+        # frame sets are shared by every instance with the same name, size and scale
+        self.animations = AnimationLibrary.get_animations(self.name, self.size, self.scale)
 
-        for state, animation_frames_list in self.animation_frames.items():
-            for frame in animation_frames_list:
-                image = AtlasTexture.get_image(texture_path=TEXTURE_PATH[self.name],
-                                               frame=frame,
-                                               size=self.size,
-                                               scale=self.scale)
-                self.animations[state].append(image)
+    @property
+    def image(self):
+        return animation_clock.get_frame(self.animations[self.state], self.animation_speed, self.animation_start,
+                                         self.animation_loop)
 
     def move(self, player_direction, dt):
         # normalizing a vector
         if player_direction.magnitude() > 0:
             self.direction = player_direction.normalize()
+        self.resolving = True
 
         # horizontal movement
         self.pos.x += self.direction.x * self.weight * dt
@@ -223,22 +337,20 @@ class GenericPhysicsAnimaton(pygame.sprite.Sprite):
         self.hitbox.centery = round(self.pos.y + self.hitbox_offset.y)
         self.rect.centery = self.hitbox.centery
         self.collision('vertical')
+        self.visible_sprites.move_sprite(self)
+        self.physics_sprites.move_sprite(self)
+        self.resolving = False
 
     def collision(self, direction):
-        for sprite in self.collision_sprites.sprites():
+        for sprite in self.collision_sprites.query(self.hitbox):
             if hasattr(sprite, 'hitbox'):
                 if sprite.hitbox.colliderect(self.hitbox):
                     self.collision_handler(sprite, direction)
 
-        for sprite in self.physics_sprites.sprites():
-            if hasattr(sprite, 'hitbox'):
-                if sprite.hitbox.colliderect(self.hitbox) and sprite.id != self.id:
-
-                    if 'table' in sprite.name and self.name in CAN_BE_PLACED_ON \
-                            or 'table' in self.name and sprite.name in CAN_BE_PLACED_ON:
-                        return
-
-                    self.collision_handler(sprite, direction)
+        # broadphase candidates, each pair is resolved on its own
+        for sprite in self.physics_sprites.query(self.hitbox):
+            if sprite is not self and sprite.hitbox.colliderect(self.hitbox):
+                self.resolve_contact(sprite, direction)
 
     def collision_handler(self, sprite, direction):
         if direction == 'horizontal':
@@ -268,38 +380,30 @@ class Chest(GenericPhysicsAnimaton):
 
         self.animation_speed = 25
 
+        # rolled by the level with its own generator, see GameRandom
         self.loot = []
         self.items_pool = ['key', 'ration', 'spider']
 
-        self.generate_loot()
-
-    def animate(self, dt):
-        self.animation_frame += self.animation_speed * dt
-        if self.animation_frame >= len(self.animations[self.state]):
-            return
-
-        self.image = self.animations[self.state][int(self.animation_frame)]
-
-    def generate_loot(self):
-        random_item = random.choice(self.items_pool)
+    def generate_loot(self, level_rng):
+        random_item = level_rng.choice(self.items_pool)
         self.loot.append(random_item)
 
     def open(self):
         if self.state != 'idle':
             return
 
+        # plays once from now and stays on its last frame
         self.state = 'opened'
+        self.animation_start = animation_clock.time
+        self.animation_loop = False
         for item in self.loot:
             print(f'You found {item}')
         self.loot = []
 
-    def update(self, dt):
-        if self.state == 'opened':
-            self.animate(dt)
-
 
 class Door(Generic):
-    def __init__(self, id, pos, surf, groups, z=LAYERS['main'], scale=(1, 1), name='Generic', hitbox=True):
-        super().__init__(pos, surf, groups, z, scale, name, hitbox)
-        self.id = id
-        self.door_check = self.rect.copy()
+    # where a door leads is read by Level from the map, so doors are known before streamed ones are built
+    def __init__(self, id, pos, surf, groups, z=LAYERS['main'], scale=(1, 1), name='Generic', hitbox=True,
+                 image_scale=None):
+        super().__init__(id, pos, surf, groups, z, scale, name, hitbox, image_scale)
+        self.door_check = self.rect.inflate(DOOR_REACH * 2, DOOR_REACH * 2)
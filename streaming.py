@@ -0,0 +1,167 @@
+import pygame
+from settings import *
+from sprites import TileChunk, Chest
+
+
+class LevelStreamer:
+    # builds sprites only for chunks around the player and retires distant ones, keeping object state
+    def __init__(self, level, scale=(6, 6)):
+        self.level = level
+        self.scale = scale
+        self.chunk_pixels = (CHUNK_SIZE * TILE_SIZE * scale[0], CHUNK_SIZE * TILE_SIZE * scale[1])
+
+        # tile layers: name -> (tile_id, tile_layer, tile_class, groups, rendered)
+        self.tile_layers = {}
+        # chunk_pos -> object records, a record follows its object when it is pushed into another chunk
+        self.records = {}
+
+        # chunk_pos -> sprites built for the chunk's tiles
+        self.loaded = {}
+        # record id -> (record, live object)
+        self.live = {}
+
+    def add_tile_layer(self, tile_id, tile_layer, tile_class, groups, rendered):
+        # tile data stays in the layer's grid, only chunk images and leftover tile sprites are streamed
+        self.tile_layers[tile_layer.name] = (tile_id, tile_layer, tile_class, groups, rendered)
+        if rendered:
+            self.level.tile_chunks[tile_layer.name] = {}
+
+    def add_object_layer(self, obj_id, tmx_data, tmx_layer, obj_class, groups, z):
+        for obj in tmx_data.get_layer_by_name(tmx_layer):
+            record = {'id': obj_id,
+                      'class': obj_class,
+                      'pos': (obj.x, obj.y),
+                      'surf': obj.image,
+                      'groups': groups,
+                      'z': z,
+                      'name': obj.name,
+                      'image_scale': OBJECTS_SCALE.get(obj.name),
+                      'state': None}
+            chunk_pos = (int(obj.x) // (CHUNK_SIZE * TILE_SIZE), int(obj.y) // (CHUNK_SIZE * TILE_SIZE))
+            self.records.setdefault(chunk_pos, []).append(record)
+            obj_id += 1
+
+    def get_chunk(self, point):
+        return int(point[0] // self.chunk_pixels[0]), int(point[1] // self.chunk_pixels[1])
+
+    @staticmethod
+    def get_area(center, radius):
+        return {(center[0] + x, center[1] + y)
+                for x in range(-radius, radius + 1)
+                for y in range(-radius, radius + 1)}
+
+    def update(self, player):
+        player_chunk = self.get_chunk(player.rect.center)
+        required = self.get_area(player_chunk, STREAM_RADIUS)
+
+        # prefetch the area the player is heading into, a few chunks per update
+        prefetch = set()
+        if player.direction.magnitude() > 0:
+            ahead = (player_chunk[0] + round(player.direction.x) * STREAM_PREFETCH,
+                     player_chunk[1] + round(player.direction.y) * STREAM_PREFETCH)
+            prefetch = self.get_area(ahead, STREAM_RADIUS) - required
+
+        for chunk_pos in required:
+            if chunk_pos not in self.loaded:
+                self.load_chunk(chunk_pos)
+
+        loads = 0
+        for chunk_pos in sorted(prefetch - set(self.loaded), key=lambda pos: abs(pos[0] - player_chunk[0]) + abs(pos[1] - player_chunk[1])):
+            if loads >= STREAM_PREFETCH_LOADS:
+                break
+            self.load_chunk(chunk_pos)
+            loads += 1
+
+        # one chunk of slack so walking along a border does not load and retire the same chunk
+        keep = self.get_area(player_chunk, STREAM_RADIUS + 1) | prefetch
+        retiring = [chunk_pos for chunk_pos in self.loaded if chunk_pos not in keep]
+        for chunk_pos in retiring:
+            self.retire_chunk(chunk_pos, keep)
+
+    def load_chunk(self, chunk_pos):
+        sprites = []
+        cells = TileChunk.get_cells(chunk_pos)
+        for tmx_layer, (tile_id, tile_layer, tile_class, groups, rendered) in self.tile_layers.items():
+            tiles = list(tile_layer.get_tiles(*cells, scaled=False))
+            if not tiles:
+                continue
+
+            if rendered:
+                chunk = TileChunk(chunk_pos, tile_layer, self.level.all_sprites)
+                chunk.prepare()
+                self.level.tile_chunks[tmx_layer][chunk_pos] = chunk
+                sprites.append(chunk)
+
+            if groups:
+                for x, y, _ in tiles:
+                    surf = tile_layer.get_tile(x, y)
+                    sprites.append(tile_class(tile_id, (x * TILE_SIZE, y * TILE_SIZE), surf, groups, tile_layer.z, self.scale, name=tmx_layer))
+
+        self.loaded[chunk_pos] = sprites
+
+        for record in self.records.get(chunk_pos, ()):
+            if id(record) not in self.live:
+                self.spawn_object(record)
+
+    def retire_chunk(self, chunk_pos, keep):
+        for sprite in self.loaded.pop(chunk_pos):
+            sprite.kill()
+        for chunks in self.level.tile_chunks.values():
+            chunks.pop(chunk_pos, None)
+
+        records = self.records.get(chunk_pos, [])
+        for record in list(records):
+            if id(record) not in self.live:
+                continue
+
+            obj = self.live[id(record)][1]
+            current_chunk = self.get_chunk(obj.rect.topleft)
+            if current_chunk != chunk_pos:
+                # pushed into another chunk, from now on it streams with that one
+                records.remove(record)
+                self.records.setdefault(current_chunk, []).append(record)
+                if current_chunk in keep and current_chunk in self.loaded:
+                    continue
+
+            record['state'] = LevelStreamer.save_state(obj)
+            self.despawn_object(record)
+
+    def spawn_object(self, record):
+        obj = record['class'](record['id'], record['pos'], record['surf'], record['groups'], record['z'], self.scale,
+                              name=record['name'], image_scale=record['image_scale'])
+        if record['state']:
+            LevelStreamer.restore_state(obj, record['state'])
+        elif isinstance(obj, Chest):
+            # rolled on its first spawn, later ones restore what is left
+            obj.generate_loot(self.level.rng)
+
+        self.live[id(record)] = (record, obj)
+        self.level.objects.append(obj)
+
+    def despawn_object(self, record):
+        _, obj = self.live.pop(id(record))
+        self.level.objects.remove(obj)
+        obj.kill()
+
+    @staticmethod
+    def save_state(obj):
+        state = {'rect': obj.rect.topleft}
+        if hasattr(obj, 'hitbox'):
+            state['hitbox'] = obj.hitbox.topleft
+        if hasattr(obj, 'pos'):
+            state['pos'] = pygame.math.Vector2(obj.pos)
+        # animated props look their frame up from the shared clock, their start and looping are all there is to keep
+        for attribute in ('state', 'animation_start', 'animation_loop', 'loot'):
+            if hasattr(obj, attribute):
+                value = getattr(obj, attribute)
+                state[attribute] = list(value) if isinstance(value, list) else value
+        return state
+
+    @staticmethod
+    def restore_state(obj, state):
+        obj.rect.topleft = state['rect']
+        if 'hitbox' in state:
+            obj.hitbox.topleft = state['hitbox']
+        for attribute in ('pos', 'state', 'animation_start', 'animation_loop', 'loot'):
+            if attribute in state:
+                setattr(obj, attribute, state[attribute])
@@ -1,7 +1,14 @@
 from os import walk
 import json
 import pygame
+import heapq
+import random
 import logging
+import weakref
+from collections import OrderedDict
+from types import MappingProxyType
+from settings import TEXTURE_CACHE_SIZE, TEXTURE_PATH, ANIMATION_FRAMES, DEFAULT_ANIMATIONS, SOUND_CHANNELS, \
+    SOUND_VOICE_LIMIT, MUSIC_VOLUME, MUSIC_FADE_TIME, MUSIC_DUCK_LEVEL, MUSIC_DUCK_TIME
 
 
 def import_folder(path):
@@ -26,10 +33,45 @@ def import_folder_dict(path):
     return surface_dict
 
 
+def normalize_surface(surface):
+    # brings a surface to one of the display's two blit formats: opaque images lose their alpha channel,
+    # colorkeyed ones get per pixel alpha instead, so no blit has to test both
+    if surface.get_colorkey() is not None:
+        transparent = pygame.mask.from_surface(surface)
+        transparent.invert()
+        surface = surface.convert_alpha()
+        surface.set_colorkey(None)
+        transparent.to_surface(surface, setcolor=(0, 0, 0, 0), unsetcolor=None)
+
+    if not surface.get_flags() & pygame.SRCALPHA:
+        return surface.convert()
+
+    width, height = surface.get_size()
+    if pygame.mask.from_surface(surface, 254).count() == width * height:
+        return surface.convert()
+    return surface.convert_alpha()
+
+
 class AtlasTexture:
+    # process-wide LRU cache of decoded sheets and sliced frames, bounded by TEXTURE_CACHE_SIZE bytes
+    cache = OrderedDict()
+    cache_bytes = 0
+    max_bytes = TEXTURE_CACHE_SIZE
+    hits = 0
+    misses = 0
+    loads = 0
+
     @staticmethod
     def get_image(texture_path, frame, size, scale=(1, 1), color=(0, 0, 0), x_offset=0, y_offset=0):
-        texture = pygame.image.load(texture_path).convert_alpha()
+        # returned surfaces are shared between callers, copy them before drawing onto them
+        key = ('frame', texture_path, tuple(frame), tuple(size), tuple(scale), tuple(color), x_offset, y_offset)
+        surface = AtlasTexture.get_cached(key)
+        if surface is not None:
+            AtlasTexture.hits += 1
+            return surface
+
+        AtlasTexture.misses += 1
+        texture = AtlasTexture.get_texture(texture_path)
         if not any((size, frame, texture)):
             logging.warning("input error")
             return None
@@ -38,54 +80,407 @@ class AtlasTexture:
             frame[0] * (size[0] - x_offset), frame[1] * (size[1] - y_offset), size[0], size[1]))
         surface = pygame.transform.scale(surface, (size[0] * scale[0], size[1] * scale[1]))
         surface.set_colorkey(color)
+        surface = normalize_surface(surface)
+        AtlasTexture.set_cached(key, surface)
         return surface
 
+    @staticmethod
+    def get_texture(texture_path):
+        key = ('texture', texture_path)
+        texture = AtlasTexture.get_cached(key)
+        if texture is None:
+            AtlasTexture.loads += 1
+            texture = pygame.image.load(texture_path).convert_alpha()
+            AtlasTexture.set_cached(key, texture)
+        return texture
+
+    @staticmethod
+    def has_texture(texture_path):
+        return ('texture', texture_path) in AtlasTexture.cache
+
+    @staticmethod
+    def add_texture(texture_path, texture):
+        # sheets decoded ahead of time, e.g. by a loader thread
+        AtlasTexture.set_cached(('texture', texture_path), texture)
+
+    @staticmethod
+    def get_cached(key):
+        surface = AtlasTexture.cache.get(key)
+        if surface is not None:
+            AtlasTexture.cache.move_to_end(key)
+        return surface
+
+    @staticmethod
+    def set_cached(key, surface):
+        # a key added again, e.g. a sheet decoded by two loaders, replaces the old entry and its size
+        replaced = AtlasTexture.cache.pop(key, None)
+        if replaced is not None:
+            AtlasTexture.cache_bytes -= AtlasTexture.surface_bytes(replaced)
+
+        AtlasTexture.cache[key] = surface
+        AtlasTexture.cache_bytes += AtlasTexture.surface_bytes(surface)
+
+        # evict least recently used surfaces, but always keep the one just added
+        while AtlasTexture.cache_bytes > AtlasTexture.max_bytes and len(AtlasTexture.cache) > 1:
+            _, evicted = AtlasTexture.cache.popitem(last=False)
+            AtlasTexture.cache_bytes -= AtlasTexture.surface_bytes(evicted)
+
+    @staticmethod
+    def surface_bytes(surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    @staticmethod
+    def get_stats():
+        return {'hits': AtlasTexture.hits,
+                'misses': AtlasTexture.misses,
+                'loads': AtlasTexture.loads,
+                'entries': len(AtlasTexture.cache),
+                'bytes': AtlasTexture.cache_bytes}
+
+    @staticmethod
+    def clear():
+        AtlasTexture.cache.clear()
+        AtlasTexture.cache_bytes = 0
+
+
+class ScaledSurfaces:
+    # interned scaled copies of tile and object surfaces, every placement of the same image at the same scale
+    # shares one surface. tmx maps hand out one surface per gid, so the source surface stands for its gid.
+    # source surface -> {scale: scaled copy}, weakly keyed so the copies go with the level whose map owns the source
+    surfaces = weakref.WeakKeyDictionary()
+    hits = 0
+    bytes_saved = 0
+
+    @staticmethod
+    def get_factor(scale, image_scale=None):
+        # an image_scale replaces the world scale for the image, as in Generic
+        return tuple(image_scale or scale)
+
+    @staticmethod
+    def register(surf, scale, scaled):
+        ScaledSurfaces.surfaces.setdefault(surf, {})[tuple(scale)] = normalize_surface(scaled)
+
+    @staticmethod
+    def intern(surf, scale, image_scale=None):
+        # the shared copy, tile layers index their surfaces once so they never would have copied per placement
+        factor = ScaledSurfaces.get_factor(scale, image_scale)
+        copies = ScaledSurfaces.surfaces.setdefault(surf, {})
+        scaled = copies.get(factor)
+        if scaled is None:
+            scaled = normalize_surface(pygame.transform.scale(surf, (surf.get_width() * factor[0], surf.get_height() * factor[1])))
+            copies[factor] = scaled
+        return scaled
+
+    @staticmethod
+    def get(surf, scale, image_scale=None):
+        # for sprites, which would each have scaled their own copy without interning
+        scaled = ScaledSurfaces.surfaces.get(surf, {}).get(ScaledSurfaces.get_factor(scale, image_scale))
+        if scaled is None:
+            return ScaledSurfaces.intern(surf, scale, image_scale)
+
+        ScaledSurfaces.hits += 1
+        ScaledSurfaces.bytes_saved += AtlasTexture.surface_bytes(scaled)
+        return scaled
+
+    @staticmethod
+    def get_stats():
+        copies = [scaled for scales in ScaledSurfaces.surfaces.values() for scaled in scales.values()]
+        return {'surfaces': len(copies),
+                'bytes': sum(AtlasTexture.surface_bytes(surf) for surf in copies),
+                'surfaces_saved': ScaledSurfaces.hits,
+                'bytes_saved': ScaledSurfaces.bytes_saved}
+
+
+class AnimationLibrary:
+    # read-only frame sets shared by every animated object with the same name, size and scale
+    animations = {}
+
+    @staticmethod
+    def get_animations(name, size, scale):
+        key = (name, tuple(size), tuple(scale))
+        if key not in AnimationLibrary.animations:
+            animations = {state: () for state in DEFAULT_ANIMATIONS[name]}
+            for state, animation_frames_list in ANIMATION_FRAMES[name].items():
+                animations[state] = tuple(AtlasTexture.get_image(texture_path=TEXTURE_PATH[name],
+                                                                 frame=frame,
+                                                                 size=size,
+                                                                 scale=scale)
+                                          for frame in animation_frames_list)
+            AnimationLibrary.animations[key] = MappingProxyType(animations)
+
+        return AnimationLibrary.animations[key]
+
+
+class AnimationClock:
+    # simulation time shared by every animation, sprites look their frame up instead of counting their own
+    def __init__(self):
+        self.time = 0.0
+
+    def update(self, dt):
+        self.time += dt
+
+    def get_frame(self, frames, speed, start=0.0, loop=True):
+        index = int((self.time - start) * speed)
+        return frames[index % len(frames)] if loop else frames[min(index, len(frames) - 1)]
+
+
+animation_clock = AnimationClock()
+
+
+class SoundBank:
+    # decoded sounds by path, shared by every SoundManager, filled on demand or ahead of time by a loader
+    sounds = {}
+
+    @staticmethod
+    def get_sound(path):
+        if path not in SoundBank.sounds:
+            SoundBank.sounds[path] = pygame.mixer.Sound(path)
+        return SoundBank.sounds[path]
+
+    @staticmethod
+    def add_sound(path, sound):
+        SoundBank.sounds[path] = sound
+
+
+class ChannelPool:
+    # hands out mixer channels by priority and voice limits, channels report back through end events
+    def __init__(self, size=SOUND_CHANNELS, voice_limit=SOUND_VOICE_LIMIT):
+        self.size = size
+        self.voice_limit = voice_limit
+        # created on first play, the mixer is not initialised when this module is imported
+        self.channels = None
+        # end event type -> channel index
+        self.end_events = {}
+        # channel index -> [sound, key, priority, start order]
+        self.voices = {}
+        self.started = 0
+
+    def setup(self):
+        pygame.mixer.set_num_channels(self.size)
+        self.channels = [pygame.mixer.Channel(index) for index in range(self.size)]
+        for index, channel in enumerate(self.channels):
+            # end events carry no channel, so every channel gets its own event type
+            event_type = pygame.event.custom_type()
+            channel.set_endevent(event_type)
+            self.end_events[event_type] = index
+
+    def handle_event(self, event):
+        index = self.end_events.get(event.type)
+        # a stolen channel also reports an end, but is already playing its new sound
+        if index is not None and not self.channels[index].get_busy():
+            self.voices.pop(index, None)
+
+    def reclaim(self):
+        # voices whose end event was never handled, e.g. by loops that only pump the event queue
+        for index in [index for index in self.voices if not self.channels[index].get_busy()]:
+            del self.voices[index]
+
+    def count_voices(self, position, value):
+        return sum(1 for voice in self.voices.values() if voice[position] == value)
+
+    def get_channel(self, sound, key, priority, max_voices):
+        if self.count_voices(1, key) >= max_voices or self.count_voices(0, sound) >= self.voice_limit:
+            return None
+
+        for index in range(self.size):
+            if index not in self.voices:
+                return index
+
+        # steal the oldest of the least important voices, if it is not more important than the new one
+        index, voice = min(self.voices.items(), key=lambda item: (item[1][2], item[1][3]))
+        return index if voice[2] <= priority else None
+
+    def play(self, sound, key, priority=0, max_voices=1, loops=0):
+        if self.channels is None:
+            self.setup()
+
+        index = self.get_channel(sound, key, priority, max_voices)
+        if index is None:
+            self.reclaim()
+            index = self.get_channel(sound, key, priority, max_voices)
+            if index is None:
+                return None
+
+        channel = self.channels[index]
+        channel.play(sound, loops)
+        self.voices[index] = [sound, key, priority, self.started]
+        self.started += 1
+        return channel
+
+
+channel_pool = ChannelPool()
+
 
 class SoundManager:
-    def __init__(self, sounds):
-        self.sounds = {}
-        for name, path in sounds.items():
-            self.sounds[name] = [pygame.mixer.Sound(path),
-                                 Timer(self.seconds_to_miliseconds(pygame.mixer.Sound(path).get_length()))]
+    def __init__(self, sounds, priority=0, max_voices=1):
+        self.sounds = {name: SoundBank.get_sound(path) for name, path in sounds.items()}
+        self.priority = priority
+        # copies of one of this manager's sounds playing at once
+        self.max_voices = max_voices
 
     def play_sound(self, name):
-        if not self.sounds[name][1].active:
-            self.sounds[name][1].activate()
-            self.sounds[name][0].play()
+        return channel_pool.play(self.sounds[name], (self, name), self.priority, self.max_voices)
 
     def set_volume_to_sound(self, name, volume):
-        self.sounds[name][0].set_volume(volume)
+        self.sounds[name].set_volume(volume)
 
-    @staticmethod
-    def seconds_to_miliseconds(seconds):
-        return seconds * 1000
 
-    def update(self):
-        for item in self.sounds.values():
-            item[1].update()
+class MusicPlayer:
+    # streams tracks through pygame.mixer.music, which keeps only a small decode buffer in memory
+    def __init__(self, volume=MUSIC_VOLUME, fade_time=MUSIC_FADE_TIME):
+        self.volume = volume
+        self.fade_time = fade_time
+        self.current = None
+        # (path, loops) started once the current track has faded out
+        self.next_track = None
+        self.queue = []
+
+        # ducking scales the volume down, e.g. under dialogue
+        self.duck_level = 1
+        self.duck_target = 1
+        self.duck_speed = 0
+        self.applied_volume = None
+
+    def play(self, path, loops=0):
+        # mixer.music holds a single stream, so a crossfade is a fade out followed by a fade in
+        if pygame.mixer.music.get_busy():
+            if path != self.current:
+                self.next_track = (path, loops)
+                pygame.mixer.music.fadeout(self.fade_time)
+        else:
+            self.start(path, loops)
+
+    def enqueue(self, path, loops=0):
+        # played after the current and already queued tracks end
+        if self.current is None and self.next_track is None:
+            self.start(path, loops)
+        else:
+            self.queue.append((path, loops))
 
+    def stop(self):
+        self.queue.clear()
+        self.next_track = None
+        pygame.mixer.music.fadeout(self.fade_time)
 
-class Timer:
-    def __init__(self, duration, func=None):
-        self.duration = duration
-        self.func = func
-        self.start_time = 0
-        self.active = False
+    def start(self, path, loops):
+        pygame.mixer.music.load(path)
+        pygame.mixer.music.play(loops, fade_ms=self.fade_time)
+        self.current = path
+        self.applied_volume = None
 
-    def activate(self):
+    def duck(self, level=MUSIC_DUCK_LEVEL, duration=MUSIC_DUCK_TIME):
+        self.duck_target = level
+        self.duck_speed = abs(self.duck_level - level) / duration if duration else 0
+
+    def unduck(self, duration=MUSIC_DUCK_TIME):
+        self.duck(1, duration)
+
+    def update(self, dt):
+        # one busy check per frame, a fade out or the end of a track moves on to the next one
+        if self.current is not None and not pygame.mixer.music.get_busy():
+            self.current = None
+            if self.next_track:
+                self.start(*self.next_track)
+                self.next_track = None
+            elif self.queue:
+                self.start(*self.queue.pop(0))
+
+        if self.duck_level != self.duck_target:
+            step = self.duck_speed * dt if self.duck_speed else abs(self.duck_target - self.duck_level)
+            if self.duck_level < self.duck_target:
+                self.duck_level = min(self.duck_target, self.duck_level + step)
+            else:
+                self.duck_level = max(self.duck_target, self.duck_level - step)
+
+        volume = self.volume * self.duck_level
+        if self.current is not None and volume != self.applied_volume:
+            pygame.mixer.music.set_volume(volume)
+            self.applied_volume = volume
+
+
+music_player = MusicPlayer()
+
+class GameRandom:
+    # gameplay randomness, seeded per session so a recorded session replays the same. Every level rolls from its own
+    # generator, seeded from the session seed and its path, so what a level rolls does not depend on which other
+    # levels were built before it, or when
+    def __init__(self):
+        self.session_seed = 0
+
+    def seed(self, seed):
+        self.session_seed = seed
+
+    def for_level(self, level_path):
+        return random.Random(f'{self.session_seed}:{level_path}')
+
+
+rng = GameRandom()
+
+
+class ScheduledTimer:
+    def __init__(self, due, callback, interval):
+        self.due = due
+        self.callback = callback
+        # seconds between repeats, None fires once
+        self.interval = interval
         self.active = True
-        self.start_time = pygame.time.get_ticks()
-
-    def deactivate(self):
-        self.active = False
-        self.start_time = 0
-
-    def update(self):
-        current_time = pygame.time.get_ticks()
-        if current_time - self.start_time >= self.duration:
-            if self.func and self.start_time != 0:
-                self.func()
-            self.deactivate()
+        # bumped on every reschedule, heap entries with an older version are stale
+        self.version = 0
+
+
+class TimerScheduler:
+    # one min-heap of due times in simulation seconds, each update only touches the timers that fire
+    def __init__(self):
+        self.time = 0
+        self.paused = False
+        self.heap = []
+        self.sequence = 0
+
+    def push(self, timer):
+        heapq.heappush(self.heap, (timer.due, self.sequence, timer.version, timer))
+        self.sequence += 1
+
+    def schedule(self, delay, callback, repeat=False):
+        # a repeat that is already due again would keep update firing forever
+        if repeat and delay <= 0:
+            raise ValueError(f'repeating timers need a positive delay, got {delay}')
+        timer = ScheduledTimer(self.time + delay, callback, delay if repeat else None)
+        self.push(timer)
+        return timer
+
+    def cancel(self, timer):
+        # the heap entry is dropped lazily when it comes up
+        timer.active = False
+
+    def reschedule(self, timer, delay):
+        timer.due = self.time + delay
+        timer.active = True
+        timer.version += 1
+        self.push(timer)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def update(self, dt):
+        if self.paused:
+            return
+
+        self.time += dt
+        heap = self.heap
+        while heap and heap[0][0] <= self.time:
+            _, __, version, timer = heapq.heappop(heap)
+            if not timer.active or version != timer.version:
+                continue
+
+            if timer.interval is None:
+                timer.active = False
+            else:
+                timer.due += timer.interval
+                self.push(timer)
+            timer.callback()
 
 
 class FileManager:
@@ -0,0 +1,115 @@
+import pygame
+from array import array
+from settings import *
+from support import ScaledSurfaces
+
+
+class Tile:
+    # stands in for a tile sprite in collision queries, only built for the cells a query touches
+    __slots__ = ('name', 'hitbox')
+
+    def __init__(self, name, hitbox):
+        self.name = name
+        self.hitbox = hitbox
+
+
+class TileLayer:
+    # a tmx tile layer as a flat grid of surface indices, 0 marks an empty cell
+    def __init__(self, name, width, height, z=LAYERS['ground'], scale=(1, 1), solid=False):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.z = z
+        self.scale = scale
+        self.solid = solid
+        self.tile_size = (TILE_SIZE * scale[0], TILE_SIZE * scale[1])
+        self.cells = array('I', bytes(4 * width * height))
+
+        # surface index - 1 -> unscaled surface and the scaled copy shared with other layers,
+        # the copies are made the first time scaled tiles are asked for, which the low resolution renderer never does
+        self.surfaces = []
+        self.scaled_surfaces = []
+        self.surface_indices = {}
+
+        # tiles larger than a cell or with inflated hitboxes reach into neighbouring cells,
+        # queries widen their cell range by this much: (left, top, right, bottom)
+        self.hitbox_inflation = OBJECTS_SIZE[name][1] if name in OBJECTS_SIZE else (0, 0)
+        self.reach = (0, 0, 0, 0)
+
+    @staticmethod
+    def from_tmx(tmx_layer, z, scale, solid):
+        layer = TileLayer(tmx_layer.name, tmx_layer.width, tmx_layer.height, z, scale, solid)
+        for x, y, surf in tmx_layer.tiles():
+            layer.set_tile(x, y, surf)
+        return layer
+
+    def get_surface_index(self, surf):
+        if surf not in self.surface_indices:
+            self.surfaces.append(surf)
+            self.surface_indices[surf] = len(self.surfaces)
+
+            hitbox = self.get_hitbox(surf, 0, 0)
+            width, height = self.tile_size
+            self.reach = (max(self.reach[0], -(hitbox.left // width)),
+                          max(self.reach[1], -(hitbox.top // height)),
+                          max(self.reach[2], (hitbox.right - 1) // width),
+                          max(self.reach[3], (hitbox.bottom - 1) // height))
+        return self.surface_indices[surf]
+
+    def set_tile(self, x, y, surf):
+        if surf is None:
+            self.cells[y * self.width + x] = 0
+        else:
+            self.cells[y * self.width + x] = self.get_surface_index(surf)
+
+    def get_scaled_surfaces(self):
+        # scaled once per distinct surface, cells only hold its index
+        for surf in self.surfaces[len(self.scaled_surfaces):]:
+            self.scaled_surfaces.append(ScaledSurfaces.intern(surf, self.scale))
+        return self.scaled_surfaces
+
+    def get_hitbox(self, surf, x, y):
+        # from the unscaled surface, so collision does not need the scaled copies
+        width, height = self.tile_size
+        hitbox = pygame.Rect(x * width, y * height, surf.get_width() * self.scale[0], surf.get_height() * self.scale[1])
+        return hitbox.inflate(self.hitbox_inflation)
+
+    def get_tile(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            index = self.cells[y * self.width + x]
+            if index:
+                return self.surfaces[index - 1]
+        return None
+
+    def is_solid(self, x, y):
+        return self.solid and self.get_tile(x, y) is not None
+
+    def get_cell(self, point):
+        return int(point[0] // self.tile_size[0]), int(point[1] // self.tile_size[1])
+
+    def get_tiles(self, left=0, top=0, right=None, bottom=None, scaled=True):
+        # (x, y, surface) of the filled cells in an inclusive cell range, row by row
+        right = self.width - 1 if right is None else min(right, self.width - 1)
+        bottom = self.height - 1 if bottom is None else min(bottom, self.height - 1)
+        cells = self.cells
+        scaled_surfaces = self.get_scaled_surfaces() if scaled else self.surfaces
+        for y in range(max(top, 0), bottom + 1):
+            row = y * self.width
+            for x in range(max(left, 0), right + 1):
+                index = cells[row + x]
+                if index:
+                    yield x, y, scaled_surfaces[index - 1]
+
+    def query(self, rect):
+        width, height = self.tile_size
+        left = rect.left // width - self.reach[2]
+        top = rect.top // height - self.reach[3]
+        right = max(rect.right - 1, rect.left) // width + self.reach[0]
+        bottom = max(rect.bottom - 1, rect.top) // height + self.reach[1]
+
+        found = []
+        for x, y, surf in self.get_tiles(left, top, right, bottom, scaled=False):
+            hitbox = self.get_hitbox(surf, x, y)
+            if hitbox.colliderect(rect):
+                found.append(Tile(self.name, hitbox))
+        return found